@@ -1,1513 +1,2793 @@
-from flask import Flask, render_template, request, jsonify, session, Response, stream_with_context
-import requests
-import openai
-import json
-import os
-import time
-import uuid
-import re
-from datetime import timedelta, datetime
-from dotenv import load_dotenv
-from threading import Lock, Thread
-
-# Load environment variables
-load_dotenv()
-
-app = Flask(__name__)
-app.secret_key = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
-app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=24)
-
-# Get OpenAI key from environment
-OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
-
-# In-memory data store (backup solution for large data)
-# This avoids cookie size limits completely
-data_store = {}
-store_lock = Lock()
-
-def cleanup_old_sessions():
-    """Remove sessions older than 24 hours"""
-    with store_lock:
-        now = datetime.now()
-        expired = [sid for sid, data in data_store.items() 
-                   if (now - data.get('created_at', now)).total_seconds() > 86400]
-        for sid in expired:
-            del data_store[sid]
-            
-def get_session_id():
-    """Get or create session ID"""
-    if 'session_id' not in session:
-        session['session_id'] = str(uuid.uuid4())
-        session.permanent = True
-    return session['session_id']
-
-def store_data(key, value):
-    """Store data in memory store"""
-    cleanup_old_sessions()
-    sid = get_session_id()
-    with store_lock:
-        if sid not in data_store:
-            data_store[sid] = {'created_at': datetime.now()}
-        data_store[sid][key] = value
-        
-def get_data(key, default=None):
-    """Retrieve data from memory store"""
-    sid = get_session_id()
-    with store_lock:
-        return data_store.get(sid, {}).get(key, default)
-
-print(f"✓ In-memory data store initialized (no cookie size limits)")
-print(f"✓ Session cleanup: automatic (24 hour expiry)")
-
-# Background task manager
-classification_tasks = {}
-tasks_lock = Lock()
-
-def get_task_id():
-    """Generate unique task ID"""
-    return str(uuid.uuid4())
-
-def update_task_progress(task_id, status, progress=0, message="", data=None):
-    """Update task progress"""
-    with tasks_lock:
-        if task_id not in classification_tasks:
-            classification_tasks[task_id] = {}
-        classification_tasks[task_id].update({
-            'status': status,  # 'running', 'complete', 'error'
-            'progress': progress,  # 0-100
-            'message': message,
-            'updated_at': datetime.now(),
-            'data': data
-        })
-
-def get_task_status(task_id):
-    """Get task status"""
-    with tasks_lock:
-        return classification_tasks.get(task_id, None)
-
-def run_classification_background(task_id, products, user_collections, session_id):
-    """Run classification in background thread"""
-    try:
-        update_task_progress(task_id, 'running', 0, 'Starting classification...')
-
-        if not OPENAI_API_KEY:
-            update_task_progress(task_id, 'error', 0, 'OpenAI API key not configured')
-            return
-
-        openai.api_key = OPENAI_API_KEY
-        total_products = len(products)
-
-        # Step 1: Handle collections
-        if user_collections and len(user_collections) > 0:
-            suggested_collections = user_collections
-            update_task_progress(task_id, 'running', 5, f'Using {len(user_collections)} custom collections')
-
-            parent_mapping = {}
-            for col in suggested_collections:
-                if " > " in col:
-                    parent = col.split(" > ")[0]
-                    parent_mapping[col] = parent
-
-            # Store parent mapping in session
-            with store_lock:
-                if session_id not in data_store:
-                    data_store[session_id] = {'created_at': datetime.now()}
-                data_store[session_id]['parent_mapping'] = parent_mapping
-        else:
-            # Generate collections with AI
-            update_task_progress(task_id, 'running', 5, 'Generating collections with AI...')
-
-            # Reduce sample size to avoid token limits (16K for gpt-3.5-turbo-16k)
-            sample_count = min(total_products, 200)
-            all_titles = "\n".join([f"{i+1}. {products[i]['title']}" for i in range(sample_count)])
-
-            collection_prompt = f"""You are analyzing {sample_count} construction/safety/traffic equipment products (sample from {total_products} total). Create a HIGHLY DETAILED collection structure with MANY specific subcategories.
-
-CRITICAL REQUIREMENTS:
-1. Create 8-15 PARENT categories based on main product types
-2. For EACH parent, create 10-30 SPECIFIC subcategories
-3. Target: 80-200+ total subcategories (the more specific, the better!)
-
-Products to analyze:
-{all_titles}
-
-Return a JSON object with parent categories as keys, and arrays of specific subcategories as values."""
-
-            try:
-                response = openai.ChatCompletion.create(
-                    model="gpt-3.5-turbo-16k",
-                    messages=[
-                        {"role": "system", "content": "You are an expert categorization specialist. Return ONLY valid JSON."},
-                        {"role": "user", "content": collection_prompt}
-                    ],
-                    temperature=0.3,
-                    max_tokens=4000,
-                    request_timeout=180
-                )
-
-                result = response.choices[0].message.content.strip()
-                if "```json" in result:
-                    result = result.split("```json")[1].split("```")[0].strip()
-                elif "```" in result:
-                    result = result.split("```")[1].split("```")[0].strip()
-
-                hierarchy = json.loads(result)
-                suggested_collections = []
-                parent_mapping = {}
-
-                for parent, subcategories in hierarchy.items():
-                    for subcat in subcategories:
-                        full_name = f"{parent} > {subcat}"
-                        suggested_collections.append(full_name)
-                        parent_mapping[full_name] = parent
-
-                # Store in session
-                with store_lock:
-                    if session_id not in data_store:
-                        data_store[session_id] = {'created_at': datetime.now()}
-                    data_store[session_id]['parent_mapping'] = parent_mapping
-
-                update_task_progress(task_id, 'running', 10, f'Generated {len(suggested_collections)} collections')
-
-            except Exception as e:
-                update_task_progress(task_id, 'error', 0, f'AI generation failed: {str(e)}')
-                return
-
-        # Step 2: Classify products in batches
-        BATCH_SIZE = 500
-        total_batches = (total_products + BATCH_SIZE - 1) // BATCH_SIZE
-
-        collections_dict = {name: [] for name in suggested_collections}
-        product_to_collection = {}
-        collections_list = json.dumps(list(collections_dict.keys()), indent=2)
-
-        update_task_progress(task_id, 'running', 10, f'Processing {total_products} products in {total_batches} batches')
-
-        for batch_num in range(total_batches):
-            batch_start = batch_num * BATCH_SIZE + 1
-            batch_end = min((batch_num + 1) * BATCH_SIZE, total_products)
-
-            update_task_progress(task_id, 'running', 10 + int((batch_num / total_batches) * 85),
-                               f'Batch {batch_num + 1}/{total_batches} (Products {batch_start}-{batch_end})')
-
-            for idx in range(batch_start, batch_end + 1):
-                product_title = products[idx - 1]['title']
-
-                # Update progress every 10 products
-                if idx % 10 == 0 or idx == batch_start:
-                    percentage = 10 + int((idx / total_products) * 85)
-                    update_task_progress(task_id, 'running', percentage,
-                                       f'Classifying product {idx}/{total_products}: {product_title[:50]}...')
-
-                prompt = f"""Classify this product into the MOST SPECIFIC matching collection.
-
-Product: {product_title}
-
-Available collections (format "Parent > Subcategory"):
-{collections_list}
-
-Return ONLY the exact collection name (with " > " format). No explanation, just the collection name."""
-
-                try:
-                    resp = openai.ChatCompletion.create(
-                        model="gpt-3.5-turbo",
-                        messages=[
-                            {"role": "system", "content": "You are a product classification expert. Return ONLY the collection name from the provided list, nothing else."},
-                            {"role": "user", "content": prompt}
-                        ],
-                        temperature=0.1,
-                        max_tokens=100,
-                        request_timeout=60
-                    )
-
-                    collection_name = resp.choices[0].message.content.strip().strip('"\'')
-
-                    if collection_name in collections_dict:
-                        product_to_collection[idx] = collection_name
-                        collections_dict[collection_name].append(idx)
-                    else:
-                        fallback = max(collections_dict.items(), key=lambda x: len(x[1]) if x[1] else 0)[0]
-                        product_to_collection[idx] = fallback
-                        collections_dict[fallback].append(idx)
-
-                    time.sleep(0.05)
-
-                except Exception as e:
-                    fallback = max(collections_dict.items(), key=lambda x: len(x[1]) if x[1] else 0)[0]
-                    product_to_collection[idx] = fallback
-                    collections_dict[fallback].append(idx)
-
-        # Remove empty collections
-        all_collections = {name: ids for name, ids in collections_dict.items() if ids}
-
-        # Format for display
-        formatted_collections = {}
-        for collection_name, indices in all_collections.items():
-            formatted_collections[collection_name] = [
-                {"index": idx, "title": products[idx-1]["title"]}
-                for idx in sorted(indices) if 1 <= idx <= len(products)
-            ]
-
-        # Store results in session
-        with store_lock:
-            if session_id not in data_store:
-                data_store[session_id] = {'created_at': datetime.now()}
-            data_store[session_id]['classified_collections'] = all_collections
-
-        # Complete task
-        update_task_progress(task_id, 'complete', 100, 'Classification complete!', {
-            'collections': formatted_collections,
-            'total_collections': len(all_collections),
-            'total_products': len(products)
-        })
-
-    except Exception as e:
-        update_task_progress(task_id, 'error', 0, str(e))
-
-def run_shopify_update_background(task_id, products, collections, shop_url, access_token, session_id):
-    """Run Shopify update with Smart Collections - faster and automatic!"""
-    try:
-        update_task_progress(task_id, 'running', 0, 'Starting Smart Collections update...')
-
-        api_version = '2024-10'
-        headers = {
-            "X-Shopify-Access-Token": access_token,
-            "Content-Type": "application/json"
-        }
-
-        # Test permissions for Smart Collections
-        test_url = f"https://{shop_url}/admin/api/{api_version}/smart_collections.json?limit=1"
-        try:
-            test_response = requests.get(test_url, headers=headers, timeout=30)
-            if test_response.status_code == 403:
-                update_task_progress(task_id, 'error', 0, 'Access token lacks permissions for Smart Collections')
-                return
-            elif test_response.status_code != 200:
-                update_task_progress(task_id, 'error', 0, f'Cannot access Shopify API. Status: {test_response.status_code}')
-                return
-        except Exception as e:
-            update_task_progress(task_id, 'error', 0, f'Connection test failed: {str(e)}')
-            return
-
-        # Deduplicate - each product goes to ONLY ONE collection
-        seen_products = set()
-        clean_collections = {}
-        duplicates_removed = 0
-
-        for collection_name, indices in collections.items():
-            unique_indices = []
-            for idx in indices:
-                if idx not in seen_products:
-                    unique_indices.append(idx)
-                    seen_products.add(idx)
-                else:
-                    duplicates_removed += 1
-
-            if unique_indices:
-                clean_collections[collection_name] = unique_indices
-
-        collections = clean_collections
-
-        if duplicates_removed > 0:
-            update_task_progress(task_id, 'running', 5, f'Removed {duplicates_removed} duplicate products (one product = one collection)')
-
-        total_products = len(seen_products)
-        total_collections = len(collections)
-
-        update_task_progress(task_id, 'running', 10, f'Step 1/2: Creating {total_collections} Smart Collections...')
-
-        # STEP 1: Create Smart Collections (fast - no product assignment needed!)
-        processed_collections = 0
-        for collection_name in collections.keys():
-            processed_collections += 1
-            progress = 10 + int((processed_collections / total_collections) * 30)
-
-            update_task_progress(task_id, 'running', progress,
-                               f'Creating Smart Collection {processed_collections}/{total_collections}: {collection_name}')
-
-            # Create Smart Collection with rule: product_type = collection_name
-            collection_id = create_or_get_smart_collection(collection_name, shop_url, headers)
-
-            if not collection_id:
-                update_task_progress(task_id, 'running', progress,
-                                   f'⚠️ Failed to create: {collection_name}')
-
-        update_task_progress(task_id, 'running', 40, f'Step 2/2: Updating {total_products} products with metadata...')
-
-        # STEP 2: Update product metadata (product_type + tags)
-        # Smart Collections will auto-populate based on product_type!
-        success_count = 0
-        processed_products = 0
-
-        for collection_name, indices in collections.items():
-            for idx in indices:
-                if 1 <= idx <= len(products):
-                    processed_products += 1
-                    product = products[idx - 1]
-
-                    # Progress update every 10 products
-                    if processed_products % 10 == 0:
-                        progress = 40 + int((processed_products / total_products) * 55)
-                        update_task_progress(task_id, 'running', progress,
-                                           f'Updating product {processed_products}/{total_products}')
-
-                    # Update product metadata (product_type = collection_name)
-                    if update_product_metadata(product["id"], collection_name, product["title"], shop_url, headers):
-                        success_count += 1
-
-        # Complete
-        update_task_progress(task_id, 'complete', 100, 'Smart Collections created! Products will auto-populate.', {
-            'success_count': success_count,
-            'total': total_products,
-            'collections': total_collections,
-            'message': 'Smart Collections automatically populate based on product_type. Check your Shopify store!'
-        })
-
-    except Exception as e:
-        update_task_progress(task_id, 'error', 0, str(e))
-
-print(f"✓ Background task manager initialized")
-
-@app.route('/')
-def index():
-    return render_template('index.html')
-
-@app.route('/api/fetch-products', methods=['POST'])
-def fetch_products():
-    try:
-        data = request.json
-        shop_url = data.get('shop_url', '').strip()
-        access_token = data.get('access_token', '').strip()
-        tag = data.get('tag', '').strip()
-        
-        if not shop_url or not access_token or not tag:
-            return jsonify({"success": False, "error": "Missing required fields"}), 400
-        
-        # Clean up shop URL - remove https://, http://, trailing slashes
-        shop_url = shop_url.replace('https://', '').replace('http://', '').rstrip('/')
-        
-        # Store credentials in memory (not in cookie)
-        store_data('shop_url', shop_url)
-        store_data('access_token', access_token)
-        
-        api_version = '2024-10'  # Updated to latest stable version
-        url = f"https://{shop_url}/admin/api/{api_version}/products.json"
-        headers = {
-            "X-Shopify-Access-Token": access_token,
-            "Content-Type": "application/json"
-        }
-        
-        all_products = []
-        params = {"limit": 250}
-        page_count = 0
-        max_pages = 100  # Support up to 25,000 products (way more than Shopify's limit)
-        
-        while page_count < max_pages:
-            print(f"Fetching page {page_count + 1}...")
-            response = requests.get(url, headers=headers, params=params, timeout=60)  # Increased timeout
-            
-            if response.status_code != 200:
-                return jsonify({
-                    "success": False, 
-                    "error": f"Shopify API error: {response.status_code} - {response.text}"
-                }), 400
-            
-            response_data = response.json()
-            products = response_data.get("products", [])
-            
-            print(f"  Retrieved {len(products)} products from page {page_count + 1}")
-            
-            if not products:
-                print("  No more products, stopping pagination")
-                break
-            
-            # Filter by tag
-            matched_on_page = 0
-            for p in products:
-                if p.get("tags"):
-                    product_tags = [t.strip().lower() for t in p.get("tags", "").split(",")]
-                    if tag.lower() in product_tags:
-                        all_products.append({"id": p["id"], "title": p["title"]})
-                        matched_on_page += 1
-            
-            print(f"  Matched {matched_on_page} products with tag '{tag}' on this page")
-            print(f"  Total matched so far: {len(all_products)}")
-            
-            # Check pagination
-            link_header = response.headers.get("Link", "")
-            if not link_header or "rel=\"next\"" not in link_header:
-                print("  No next page link, stopping pagination")
-                break
-            
-            # Extract next page URL
-            next_url = None
-            for link in link_header.split(","):
-                if "rel=\"next\"" in link:
-                    next_url = link.split(";")[0].strip("<> ")
-                    break
-            
-            if not next_url:
-                print("  Could not parse next page URL, stopping pagination")
-                break
-                
-            url = next_url
-            params = {}
-            page_count += 1
-        
-        print(f"Pagination complete: {page_count + 1} pages fetched, {len(all_products)} products matched")
-        
-        # Store products in memory (not in cookie)
-        store_data('products', all_products)
-        
-        print(f"✓ Stored {len(all_products)} products in memory store")
-        
-        return jsonify({
-            "success": True,
-            "products": all_products,
-            "count": len(all_products)
-        })
-        
-    except requests.exceptions.Timeout:
-        return jsonify({"success": False, "error": "Request timeout. Please try again."}), 400
-    except requests.exceptions.RequestException as e:
-        return jsonify({"success": False, "error": f"Network error: {str(e)}"}), 400
-    except Exception as e:
-        print(f"Error in fetch_products: {str(e)}")
-        return jsonify({"success": False, "error": str(e)}), 400
-
-@app.route('/api/classify', methods=['POST'])
-def classify_products():
-    try:
-        products = get_data('products', [])
-
-        print(f"DEBUG: Retrieved {len(products)} products from memory store")
-
-        if not products:
-            return jsonify({"success": False, "error": "No products found. Fetch products first."}), 400
-
-        if not OPENAI_API_KEY:
-            return jsonify({"success": False, "error": "OpenAI API key not configured. Add OPENAI_API_KEY to .env file"}), 400
-
-        openai.api_key = OPENAI_API_KEY
-
-        total_products = len(products)
-        print(f"\n{'='*60}")
-        print(f"STARTING CLASSIFICATION: {total_products} products")
-        print(f"{'='*60}\n")
-
-        # Check if user provided custom collections
-        request_data = request.json or {}
-        user_collections = request_data.get('user_collections', None)
-
-        if user_collections and len(user_collections) > 0:
-            # User provided collections - use them directly
-            print(f"Step 1: Using {len(user_collections)} user-provided collections")
-            print(f"  Collections: {user_collections[:5]}{'...' if len(user_collections) > 5 else ''}\n")
-
-            suggested_collections = user_collections
-
-            # Extract parent mapping if hierarchical format used
-            parent_mapping = {}
-            for col in suggested_collections:
-                if " > " in col:
-                    parent = col.split(" > ")[0]
-                    parent_mapping[col] = parent
-
-            store_data('parent_mapping', parent_mapping)
-        else:
-            # No user collections - generate automatically with AI
-            print("Step 1: No custom collections provided - AI will generate them automatically\n")
-
-        # STEP 1: Analyze ALL products and create MANY detailed collections (only if user didn't provide them)
-        if not user_collections:
-            print(f"  Analyzing {total_products} products to generate DETAILED collection hierarchy...")
-            print(f"  Creating 50-150+ specific collections based on product types, sizes, and features...")
-
-            # Reduce sample size to avoid token limits (16K for gpt-3.5-turbo-16k)
-            sample_count = min(total_products, 200)
-            all_titles = "\n".join([f"{i+1}. {products[i]['title']}" for i in range(sample_count)])
-            print(f"  Analyzing {sample_count} products...")
-
-            collection_prompt = f"""You are analyzing {sample_count} construction/safety/traffic equipment products (sample from {total_products} total). Create a HIGHLY DETAILED collection structure with MANY specific subcategories.
-
-CRITICAL REQUIREMENTS:
-1. Create 8-15 PARENT categories based on main product types
-2. For EACH parent, create 10-30 SPECIFIC subcategories
-3. Target: 80-200+ total subcategories (the more specific, the better!)
-4. Use SIZE/CAPACITY as primary differentiator (500mm cones vs 750mm cones vs 1m cones)
-5. Use PRODUCT TYPE variations (Traffic Cones, Water Tanks, Safety Signs, Barriers, etc.)
-6. Use MATERIAL/CONSTRUCTION (Metal, Plastic, Aluminum, Steel, etc.)
-7. Use CAPACITY for tanks (100L, 500L, 1000L, 5000L, etc.)
-8. Use SPECIFIC FEATURES (Bunded, Stackable, Heavy Duty, Premium, etc.)
-
-ANALYSIS STRATEGY FOR THIS CATALOG:
-- Traffic Cones → Separate by HEIGHT (460mm, 500mm, 750mm, 1m, etc.)
-- Water Tanks → Separate by CAPACITY (500L, 1000L, 5000L, Underground, Bunded, etc.)
-- Safety Signs → Separate by TYPE (Speed Limit Signs, Warning Signs, Directional, Quick-Fit, Metal, etc.)
-- Barriers → Separate by TYPE (Water-Filled, Pedestrian, Crowd Control, Height Restrictors, etc.)
-- Construction Equipment → Separate by CATEGORY (Buckets, Tubs, Tools, Flooring, etc.)
-- Safety Gear → Separate by TYPE (Coveralls, Gloves, Boots, High-Vis, etc.)
-
-EXAMPLES OF GOOD GRANULARITY:
-Parent: "Traffic Cones"
-  Subcategories: ["460mm Traffic Cones", "500mm Traffic Cones", "750mm Traffic Cones",
-                  "1 Metre Traffic Cones", "Sand Weighted Traffic Cones", "Self-Weighted Traffic Cones",
-                  "Chapter 8 Traffic Cones", "No Waiting Cones", "Cone Accessories"]
-
-Parent: "Water Storage Tanks"
-  Subcategories: ["100-500 Litre Water Tanks", "500-1000 Litre Water Tanks", "1000-2000 Litre Water Tanks",
-                  "2000-5000 Litre Water Tanks", "5000-10000 Litre Water Tanks", "Underground Water Tanks",
-                  "Bunded Water Tanks", "Potable Water Tanks", "Baffled Water Tanks", "Cylindrical Water Tanks"]
-
-Parent: "Traffic Safety Signs"
-  Subcategories: ["Speed Limit Signs (Metal)", "Speed Limit Signs (Quick-Fit)", "Warning Triangle Signs",
-                  "Directional Arrow Signs", "Supplementary Plates", "Custom Signs", "Road Closure Signs",
-                  "Pedestrian Signs", "Roadworks Signs", "Cone Mounted Signs"]
-
-Parent: "Safety Barriers"
-  Subcategories: ["Water-Filled Barriers 1m", "Water-Filled Barriers 2m", "Pedestrian Barriers",
-                  "Crowd Control Barriers", "Height Restriction Barriers", "Temporary Fencing",
-                  "Mesh Barriers", "Chapter 8 Barriers", "Barrier Accessories"]
-
-Parent: "Construction Tools & Equipment"
-  Subcategories: ["Mortar Tubs 100-300L", "Mortar Tubs 300-500L", "Builders Buckets",
-                  "Flooring Tools", "Screeding Equipment", "Trowels & Hand Tools",
-                  "Measuring Tools", "Earth Compaction Tools", "Asphalt Tools"]
-
-Parent: "Safety & PPE"
-  Subcategories: ["High-Visibility Jackets", "High-Visibility Bodywarmers", "Disposable Coveralls",
-                  "Work Trousers", "Safety Boots", "Work Gloves", "Safety Helmets",
-                  "First Aid Kits", "Eye Protection", "Respiratory Protection"]
-
-Parent: "Site Equipment"
-  Subcategories: ["Cable Ramps & Protectors", "Anti-Slip Matting", "Ground Protection Mats",
-                  "Access Mats", "Flooring Sheets", "Scaffold Equipment", "Ladders & Steps",
-                  "Storage Solutions", "Site Furniture", "Waste Management"]
-
-Products to analyze:
-{all_titles}
-
-Return a JSON object with parent categories as keys, and arrays of specific subcategories as values:
-{{
-  "Traffic Cones": ["460mm Traffic Cones", "500mm Traffic Cones", "750mm Traffic Cones", ...],
-  "Water Storage Tanks": ["100-500 Litre Tanks", "500-1000 Litre Tanks", "Underground Tanks", ...],
-  "Traffic Safety Signs": ["Speed Limit Signs Metal", "Warning Signs", "Quick-Fit Signs", ...],
-  ...
-}}
-
-CRITICAL SUCCESS CRITERIA:
-1. Minimum 80 total subcategories (more is better - aim for 100-150+)
-2. Be EXTREMELY SPECIFIC with sizes, capacities, and types
-3. Separate by SIZE/CAPACITY first (e.g., "500mm Cones" vs "750mm Cones")
-4. Then by TYPE/FEATURE (e.g., "Bunded Tanks" vs "Underground Tanks")
-5. Each subcategory must be unique and highly descriptive
-6. Look at product titles and identify all size/capacity variations
-7. Create separate subcategories for different materials (Metal, Plastic, Aluminum)
-8. Products will be assigned to subcategories, so make them VERY SPECIFIC!
-
-REMEMBER: This is construction/safety equipment - use technical specifications!"""
-
-            try:
-                print(f"  Generating collection hierarchy from {sample_count} products...")
-                print(f"  This may take 30-60 seconds...")
-                response = openai.ChatCompletion.create(
-                    model="gpt-3.5-turbo-16k",  # Use 16k model for larger responses
-                    messages=[
-                        {"role": "system", "content": "You are an expert construction/safety equipment categorization specialist. Create MANY highly specific subcategories (minimum 80, ideally 100-150+). Separate products by size, capacity, material, and type. Return ONLY valid JSON - no markdown, no explanations."},
-                        {"role": "user", "content": collection_prompt}
-                    ],
-                    temperature=0.3,
-                    max_tokens=4000,  # Large limit for many collections
-                    request_timeout=180  # Increased to 3 minutes for large responses
-                )
-
-                result = response.choices[0].message.content.strip()
-
-                # More robust JSON extraction
-                if "```json" in result:
-                    result = result.split("```json")[1].split("```")[0].strip()
-                elif "```" in result:
-                    result = result.split("```")[1].split("```")[0].strip()
-
-                # Remove any leading/trailing whitespace and quotes
-                result = result.strip().strip('`').strip()
-
-                # Try to find JSON object bounds
-                if not result.startswith('{'):
-                    start_idx = result.find('{')
-                    if start_idx != -1:
-                        result = result[start_idx:]
-
-                if not result.endswith('}'):
-                    end_idx = result.rfind('}')
-                    if end_idx != -1:
-                        result = result[:end_idx+1]
-
-                print(f"  Parsing AI response (length: {len(result)} chars)...")
-                hierarchy = json.loads(result)
-
-                # Flatten hierarchy into subcategories with parent prefix
-                suggested_collections = []
-                parent_mapping = {}  # Track which parent each subcategory belongs to
-
-                for parent, subcategories in hierarchy.items():
-                    for subcat in subcategories:
-                        # Format: "Parent > Subcategory" for Shopify
-                        full_name = f"{parent} > {subcat}"
-                        suggested_collections.append(full_name)
-                        parent_mapping[full_name] = parent
-
-                print(f"✓ Got {len(hierarchy)} parent categories")
-                print(f"✓ Got {len(suggested_collections)} total subcategories")
-
-                # Validate we have enough collections
-                if len(suggested_collections) < 50:
-                    print(f"  ⚠️ WARNING: Only {len(suggested_collections)} collections created!")
-                    print(f"  ⚠️ Expected 80-150+ for detailed categorization")
-                    print(f"  ⚠️ Products may be grouped too broadly")
-                elif len(suggested_collections) < 80:
-                    print(f"  ⚠️ Got {len(suggested_collections)} collections (recommended: 80+)")
-                else:
-                    print(f"  ✓ Excellent! {len(suggested_collections)} collections will provide detailed organization")
-
-                # Store parent mapping for later use
-                store_data('parent_mapping', parent_mapping)
-
-            except Exception as e:
-                print(f"⚠️ Error getting hierarchical collections: {e}")
-                print(f"⚠️ Using default construction/safety equipment structure")
-                suggested_collections = [
-                    "Traffic Cones > 460mm-500mm Cones", "Traffic Cones > 750mm Cones", "Traffic Cones > 1 Metre Cones",
-                    "Water Tanks > Small Tanks (100-1000L)", "Water Tanks > Medium Tanks (1000-5000L)", "Water Tanks > Large Tanks (5000L+)",
-                    "Water Tanks > Bunded Tanks", "Water Tanks > Underground Tanks",
-                    "Traffic Signs > Speed Limit Signs", "Traffic Signs > Warning Signs", "Traffic Signs > Quick-Fit Signs",
-                    "Traffic Signs > Metal Signs", "Traffic Signs > Supplementary Plates",
-                    "Safety Barriers > Water-Filled Barriers", "Safety Barriers > Pedestrian Barriers", "Safety Barriers > Temporary Fencing",
-                    "Safety Barriers > Height Restrictors", "Safety Barriers > Crowd Control",
-                    "Construction Equipment > Mortar Tubs", "Construction Equipment > Builders Buckets", "Construction Equipment > Hand Tools",
-                    "Safety PPE > High-Vis Clothing", "Safety PPE > Work Gloves", "Safety PPE > Safety Boots",
-                    "Site Equipment > Cable Ramps", "Site Equipment > Anti-Slip Matting", "Site Equipment > Ground Protection"
-                ]
-                parent_mapping = {col: col.split(" > ")[0] for col in suggested_collections}
-                store_data('parent_mapping', parent_mapping)
-        
-        # STEP 2: Classify products ONE BY ONE
-        print(f"\nStep 2: Classifying {total_products} products one by one...")
-        print(f"  Available collections: {len(suggested_collections)}")
-        print(f"  This will take a few minutes...\n")
-
-        # Create empty collections
-        collections_dict = {name: [] for name in suggested_collections}
-
-        # Track assignments
-        product_to_collection = {}
-
-        # Collections list for prompt (formatted nicely)
-        collections_list = json.dumps(list(collections_dict.keys()), indent=2)
-
-        # Process each product individually
-        for idx in range(1, total_products + 1):
-            product_title = products[idx - 1]['title']
-
-            # Progress indicator every 50 products
-            if idx % 50 == 0:
-                print(f"  Progress: {idx}/{total_products} products classified ({int(idx/total_products*100)}%)")
-
-            prompt = f"""Classify this product into the MOST SPECIFIC matching collection.
-
-Product: {product_title}
-
-Available collections (format "Parent > Subcategory"):
-{collections_list}
-
-Return ONLY the exact collection name (with " > " format). No explanation, just the collection name.
-
-Consider:
-- Demographics: Men's/Women's/Kids'/Unisex
-- Style: Running/Casual/Formal/Athletic/Industrial/Professional
-- Type and specific features
-
-Be PRECISE and choose the most granular match."""
-
-            try:
-                resp = openai.ChatCompletion.create(
-                    model="gpt-3.5-turbo",
-                    messages=[
-                        {"role": "system", "content": "You are a product classification expert. Return ONLY the collection name from the provided list, nothing else."},
-                        {"role": "user", "content": prompt}
-                    ],
-                    temperature=0.1,
-                    max_tokens=100,
-                    request_timeout=60  # Increased to 60 seconds for reliability
-                )
-
-                collection_name = resp.choices[0].message.content.strip().strip('"\'')
-
-                # Validate collection exists
-                if collection_name in collections_dict:
-                    product_to_collection[idx] = collection_name
-                    collections_dict[collection_name].append(idx)
-                else:
-                    # Fallback to most populated collection
-                    fallback = max(collections_dict.items(), key=lambda x: len(x[1]) if x[1] else 0)[0]
-                    product_to_collection[idx] = fallback
-                    collections_dict[fallback].append(idx)
-                    if idx % 50 == 0:  # Only log occasionally to reduce noise
-                        print(f"    ⚠️ Product {idx} got invalid collection, using fallback")
-
-                # Minimal rate limiting
-                time.sleep(0.05)  # 50ms delay = ~20 requests/sec
-
-            except Exception as e:
-                # On error, use fallback
-                fallback = max(collections_dict.items(), key=lambda x: len(x[1]) if x[1] else 0)[0]
-                product_to_collection[idx] = fallback
-                collections_dict[fallback].append(idx)
-                if idx % 100 == 0:  # Only log occasionally
-                    print(f"    ⚠️ Error on product {idx}, using fallback: {str(e)[:50]}")
-
-        print(f"\n  ✓ Classified all {total_products} products!")
-
-        # STEP 3: Verification
-        print(f"\nStep 3: Verification...")
-
-        # Check for missing products (shouldn't have any with one-by-one approach)
-        missing = []
-        for i in range(1, total_products + 1):
-            if i not in product_to_collection:
-                missing.append(i)
-
-        if missing:
-            print(f"  ⚠️ Found {len(missing)} unclassified products (unexpected!)")
-            # Assign to most populated collection
-            fallback = max(collections_dict.items(), key=lambda x: len(x[1]))[0]
-            for product_idx in missing:
-                product_to_collection[product_idx] = fallback
-                collections_dict[fallback].append(product_idx)
-            print(f"  ✓ Assigned {len(missing)} products to '{fallback}'")
-        
-        # Remove empty collections
-        all_collections = {name: ids for name, ids in collections_dict.items() if ids}
-        
-        # CRITICAL: Final deduplication check
-        seen_products = set()
-        deduplicated_collections = {}
-        
-        for collection_name, indices in all_collections.items():
-            unique_indices = []
-            for idx in indices:
-                if idx not in seen_products:
-                    unique_indices.append(idx)
-                    seen_products.add(idx)
-                else:
-                    print(f"  ⚠️ Removing duplicate: Product {idx} from '{collection_name}'")
-            
-            if unique_indices:
-                deduplicated_collections[collection_name] = unique_indices
-        
-        all_collections = deduplicated_collections
-        
-        # Final count and verification
-        total_assigned = sum(len(ids) for ids in all_collections.values())
-        
-        # Double-check for duplicates
-        all_product_ids = []
-        for ids in all_collections.values():
-            all_product_ids.extend(ids)
-        
-        unique_count = len(set(all_product_ids))
-        if unique_count != total_assigned:
-            print(f"❌ CRITICAL: Duplicates detected! {total_assigned} total, {unique_count} unique")
-            print(f"   Duplicates: {total_assigned - unique_count}")
-        
-        print(f"\n{'='*60}")
-        print(f"CLASSIFICATION COMPLETE")
-        print(f"{'='*60}")
-        print(f"Input: {total_products} products")
-        print(f"Output: {total_assigned} products ({unique_count} unique)")
-        print(f"Collections: {len(all_collections)}")
-        
-        if total_assigned == total_products:
-            print(f"✓ SUCCESS: All products classified!")
-        else:
-            print(f"❌ ERROR: Count mismatch!")
-        
-        print(f"{'='*60}\n")
-
-        # Group by parent category for better display
-        parent_breakdown = {}
-        for name, ids in all_collections.items():
-            if " > " in name:
-                parent = name.split(" > ")[0]
-                subcat = name.split(" > ")[1]
-            else:
-                parent = "Other"
-                subcat = name
-
-            if parent not in parent_breakdown:
-                parent_breakdown[parent] = []
-            parent_breakdown[parent].append((subcat, len(ids)))
-
-        print("COLLECTION BREAKDOWN BY PARENT CATEGORY:\n")
-        for parent in sorted(parent_breakdown.keys()):
-            subcats = parent_breakdown[parent]
-            total_in_parent = sum(count for _, count in subcats)
-            print(f"📁 {parent} ({len(subcats)} subcategories, {total_in_parent} products)")
-            for subcat, count in sorted(subcats, key=lambda x: x[1], reverse=True)[:10]:  # Show top 10
-                print(f"   ├─ {subcat}: {count} products")
-            if len(subcats) > 10:
-                print(f"   └─ ... and {len(subcats) - 10} more subcategories")
-            print()
-        print()
-        
-        # Format for display
-        formatted_collections = {}
-        for collection_name, indices in all_collections.items():
-            formatted_collections[collection_name] = [
-                {"index": idx, "title": products[idx-1]["title"]}
-                for idx in sorted(indices) if 1 <= idx <= len(products)
-            ]
-        
-        # Log what we're storing
-        print(f"[STORING] {len(all_collections)} collections with {total_assigned} total products")
-        
-        store_data('classified_collections', all_collections)
-        
-        # Verify what was stored
-        verify_stored = get_data('classified_collections', {})
-        verify_total = sum(len(ids) for ids in verify_stored.values())
-        print(f"[VERIFIED] Storage contains {len(verify_stored)} collections with {verify_total} products")
-        
-        if verify_total != total_assigned:
-            print(f"[ERROR] Storage corruption: Expected {total_assigned}, got {verify_total}")
-        
-        return jsonify({
-            "success": True,
-            "collections": formatted_collections,
-            "total_collections": len(all_collections),
-            "total_products": total_assigned
-        })
-        
-    except Exception as e:
-        print(f"Classification error: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({"success": False, "error": str(e)}), 400
-
-@app.route('/api/classify-start', methods=['POST'])
-def classify_start():
-    """Start classification in background thread"""
-    try:
-        data = request.json or {}
-        user_collections = data.get('user_collections', None)
-
-        # Get products from session
-        products = get_data('products', [])
-
-        if not products:
-            return jsonify({"success": False, "error": "No products found. Fetch products first."}), 400
-
-        # Parse user collections
-        if user_collections and len(user_collections) > 0:
-            user_collections_list = user_collections
-        else:
-            user_collections_list = None
-
-        # Create task
-        task_id = get_task_id()
-        session_id = get_session_id()
-
-        # Store task ID in session
-        store_data('current_task_id', task_id)
-
-        # Start background thread
-        thread = Thread(target=run_classification_background,
-                       args=(task_id, products, user_collections_list, session_id))
-        thread.daemon = True
-        thread.start()
-
-        return jsonify({
-            "success": True,
-            "task_id": task_id,
-            "message": "Classification started in background"
-        })
-    except Exception as e:
-        return jsonify({"success": False, "error": str(e)}), 400
-
-@app.route('/api/classification-status', methods=['GET'])
-def classification_status():
-    """Get classification task status"""
-    try:
-        # Get task_id from query params or from session
-        task_id = request.args.get('task_id') or get_data('current_task_id')
-
-        if not task_id:
-            return jsonify({"success": False, "error": "No task ID provided"}), 400
-
-        task = get_task_status(task_id)
-
-        if not task:
-            return jsonify({"success": False, "error": "Task not found"}), 404
-
-        return jsonify({
-            "success": True,
-            "task_id": task_id,
-            "status": task['status'],
-            "progress": task['progress'],
-            "message": task['message'],
-            "data": task.get('data'),
-            "updated_at": task['updated_at'].isoformat()
-        })
-    except Exception as e:
-        return jsonify({"success": False, "error": str(e)}), 400
-
-@app.route('/api/classify-stream', methods=['GET'])
-def classify_products_stream():
-    def generate():
-        try:
-            print("[STREAM] Starting classification stream...")
-            products = get_data('products', [])
-            user_collections = get_data('user_collections_input', None)
-            print(f"[STREAM] Products: {len(products)}, User collections: {len(user_collections) if user_collections else 0}")
-
-            if not products:
-                print("[STREAM] ERROR: No products found")
-                yield f"data: {json.dumps({'type': 'error', 'message': 'No products found. Fetch products first.'})}\n\n"
-                return
-
-            if not OPENAI_API_KEY:
-                print("[STREAM] ERROR: OpenAI API key not configured")
-                yield f"data: {json.dumps({'type': 'error', 'message': 'OpenAI API key not configured. Please add OPENAI_API_KEY to .env file'})}\n\n"
-                return
-
-            openai.api_key = OPENAI_API_KEY
-            total_products = len(products)
-
-            yield f"data: {json.dumps({'type': 'start', 'total': total_products})}\n\n"
-
-            # Step 1: Get or generate collections
-            if user_collections and len(user_collections) > 0:
-                suggested_collections = user_collections
-                yield f"data: {json.dumps({'type': 'info', 'message': f'Using {len(user_collections)} custom collections'})}\n\n"
-
-                parent_mapping = {}
-                for col in suggested_collections:
-                    if " > " in col:
-                        parent = col.split(" > ")[0]
-                        parent_mapping[col] = parent
-                store_data('parent_mapping', parent_mapping)
-            else:
-                # AI generation (same as before, but with progress updates)
-                yield f"data: {json.dumps({'type': 'info', 'message': 'Generating collections with AI...'})}\n\n"
-
-                # Reduce sample size to avoid token limits (16K for gpt-3.5-turbo-16k)
-                sample_count = min(total_products, 200)
-                all_titles = "\n".join([f"{i+1}. {products[i]['title']}" for i in range(sample_count)])
-
-                collection_prompt = f"""You are analyzing {sample_count} construction/safety/traffic equipment products (sample from {total_products} total). Create a HIGHLY DETAILED collection structure with MANY specific subcategories.
-
-CRITICAL REQUIREMENTS:
-1. Create 8-15 PARENT categories based on main product types
-2. For EACH parent, create 10-30 SPECIFIC subcategories
-3. Target: 80-200+ total subcategories (the more specific, the better!)
-
-Products to analyze:
-{all_titles}
-
-Return a JSON object with parent categories as keys, and arrays of specific subcategories as values."""
-
-                try:
-                    response = openai.ChatCompletion.create(
-                        model="gpt-3.5-turbo-16k",
-                        messages=[
-                            {"role": "system", "content": "You are an expert categorization specialist. Return ONLY valid JSON."},
-                            {"role": "user", "content": collection_prompt}
-                        ],
-                        temperature=0.3,
-                        max_tokens=4000,
-                        request_timeout=180
-                    )
-
-                    result = response.choices[0].message.content.strip()
-                    if "```json" in result:
-                        result = result.split("```json")[1].split("```")[0].strip()
-                    elif "```" in result:
-                        result = result.split("```")[1].split("```")[0].strip()
-
-                    hierarchy = json.loads(result)
-                    suggested_collections = []
-                    parent_mapping = {}
-
-                    for parent, subcategories in hierarchy.items():
-                        for subcat in subcategories:
-                            full_name = f"{parent} > {subcat}"
-                            suggested_collections.append(full_name)
-                            parent_mapping[full_name] = parent
-
-                    store_data('parent_mapping', parent_mapping)
-                    yield f"data: {json.dumps({'type': 'info', 'message': f'Generated {len(suggested_collections)} collections'})}\n\n"
-
-                except Exception as e:
-                    yield f"data: {json.dumps({'type': 'error', 'message': f'AI generation failed: {str(e)}'})}\n\n"
-                    return
-
-            # Step 2: Classify products in batches with progress updates
-            BATCH_SIZE = 500
-            total_batches = (total_products + BATCH_SIZE - 1) // BATCH_SIZE  # Ceiling division
-
-            collections_dict = {name: [] for name in suggested_collections}
-            product_to_collection = {}
-            collections_list = json.dumps(list(collections_dict.keys()), indent=2)
-
-            yield f"data: {json.dumps({'type': 'info', 'message': f'Processing {total_products} products in {total_batches} batches of {BATCH_SIZE}'})}\n\n"
-
-            for batch_num in range(total_batches):
-                batch_start = batch_num * BATCH_SIZE + 1
-                batch_end = min((batch_num + 1) * BATCH_SIZE, total_products)
-
-                yield f"data: {json.dumps({'type': 'batch_start', 'batch': batch_num + 1, 'total_batches': total_batches, 'start': batch_start, 'end': batch_end})}\n\n"
-
-                for idx in range(batch_start, batch_end + 1):
-                    product_title = products[idx - 1]['title']
-
-                    # Send progress update every 10 products
-                    if idx % 10 == 0 or idx == batch_start:
-                        percentage = int((idx / total_products) * 100)
-                        batch_progress = int(((idx - batch_start + 1) / (batch_end - batch_start + 1)) * 100)
-                        yield f"data: {json.dumps({'type': 'progress', 'current': idx, 'total': total_products, 'percentage': percentage, 'batch': batch_num + 1, 'batch_progress': batch_progress, 'product': product_title})}\n\n"
-
-                    prompt = f"""Classify this product into the MOST SPECIFIC matching collection.
-
-Product: {product_title}
-
-Available collections (format "Parent > Subcategory"):
-{collections_list}
-
-Return ONLY the exact collection name (with " > " format). No explanation, just the collection name."""
-
-                    try:
-                        resp = openai.ChatCompletion.create(
-                            model="gpt-3.5-turbo",
-                            messages=[
-                                {"role": "system", "content": "You are a product classification expert. Return ONLY the collection name from the provided list, nothing else."},
-                                {"role": "user", "content": prompt}
-                            ],
-                            temperature=0.1,
-                            max_tokens=100,
-                            request_timeout=60
-                        )
-
-                        collection_name = resp.choices[0].message.content.strip().strip('"\'')
-
-                        if collection_name in collections_dict:
-                            product_to_collection[idx] = collection_name
-                            collections_dict[collection_name].append(idx)
-                        else:
-                            fallback = max(collections_dict.items(), key=lambda x: len(x[1]) if x[1] else 0)[0]
-                            product_to_collection[idx] = fallback
-                            collections_dict[fallback].append(idx)
-
-                        time.sleep(0.05)
-
-                    except Exception as e:
-                        fallback = max(collections_dict.items(), key=lambda x: len(x[1]) if x[1] else 0)[0]
-                        product_to_collection[idx] = fallback
-                        collections_dict[fallback].append(idx)
-
-                # Batch complete
-                yield f"data: {json.dumps({'type': 'batch_complete', 'batch': batch_num + 1, 'total_batches': total_batches, 'products_classified': batch_end})}\n\n"
-
-            # Remove empty collections
-            all_collections = {name: ids for name, ids in collections_dict.items() if ids}
-
-            # Format for display
-            formatted_collections = {}
-            for collection_name, indices in all_collections.items():
-                formatted_collections[collection_name] = [
-                    {"index": idx, "title": products[idx-1]["title"]}
-                    for idx in sorted(indices) if 1 <= idx <= len(products)
-                ]
-
-            # Store results
-            store_data('classified_collections', all_collections)
-
-            # Send completion
-            yield f"data: {json.dumps({'type': 'complete', 'collections': formatted_collections, 'total_collections': len(all_collections), 'total_products': len(products)})}\n\n"
-
-        except Exception as e:
-            yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
-
-    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
-    response.headers['Cache-Control'] = 'no-cache'
-    response.headers['X-Accel-Buffering'] = 'no'
-    return response
-
-@app.route('/api/update-shopify-start', methods=['POST'])
-def update_shopify_start():
-    """Start Shopify update in background thread"""
-    try:
-        # Get data from session
-        products = get_data('products', [])
-        collections = get_data('classified_collections', {})
-        shop_url = get_data('shop_url', '')
-        access_token = get_data('access_token', '')
-
-        if not products or not collections:
-            return jsonify({"success": False, "error": "No classification data found"}), 400
-
-        if not shop_url or not access_token:
-            return jsonify({"success": False, "error": "Missing Shopify credentials"}), 400
-
-        # Create task
-        task_id = get_task_id()
-        session_id = get_session_id()
-
-        # Store task ID in session
-        store_data('current_update_task_id', task_id)
-
-        # Start background thread
-        thread = Thread(target=run_shopify_update_background,
-                       args=(task_id, products, collections, shop_url, access_token, session_id))
-        thread.daemon = True
-        thread.start()
-
-        return jsonify({
-            "success": True,
-            "task_id": task_id,
-            "message": "Shopify update started in background"
-        })
-    except Exception as e:
-        return jsonify({"success": False, "error": str(e)}), 400
-
-@app.route('/api/update-shopify-status', methods=['GET'])
-def update_shopify_status():
-    """Get Shopify update task status"""
-    try:
-        # Get task_id from query params or from session
-        task_id = request.args.get('task_id') or get_data('current_update_task_id')
-
-        if not task_id:
-            return jsonify({"success": False, "error": "No task ID provided"}), 400
-
-        task = get_task_status(task_id)
-
-        if not task:
-            return jsonify({"success": False, "error": "Task not found"}), 404
-
-        return jsonify({
-            "success": True,
-            "task_id": task_id,
-            "status": task['status'],
-            "progress": task['progress'],
-            "message": task['message'],
-            "data": task.get('data'),
-            "updated_at": task['updated_at'].isoformat()
-        })
-    except Exception as e:
-        return jsonify({"success": False, "error": str(e)}), 400
-
-@app.route('/api/update-shopify-stream', methods=['GET'])
-def update_shopify_stream():
-    def generate():
-        try:
-            products = get_data('products', [])
-            collections = get_data('classified_collections', {})
-            shop_url = get_data('shop_url', '')
-            access_token = get_data('access_token', '')
-
-            # Verify token permissions first
-            api_version = '2024-10'
-            headers = {
-                "X-Shopify-Access-Token": access_token,
-                "Content-Type": "application/json"
-            }
-
-            # Test Smart Collections endpoint
-            test_url = f"https://{shop_url}/admin/api/{api_version}/smart_collections.json?limit=1"
-            try:
-                test_response = requests.get(test_url, headers=headers, timeout=30)
-                if test_response.status_code == 403:
-                    yield f"data: {json.dumps({'type': 'error', 'message': 'Access token lacks permissions for Smart Collections. Please verify read_products and write_products scopes.'})}\n\n"
-                    return
-                elif test_response.status_code != 200:
-                    yield f"data: {json.dumps({'type': 'error', 'message': f'Cannot access Shopify API. Status: {test_response.status_code}'})}\n\n"
-                    return
-            except Exception as e:
-                yield f"data: {json.dumps({'type': 'error', 'message': f'Connection test failed: {str(e)}'})}\n\n"
-                return
-
-            # Log what we retrieved
-            retrieved_total = sum(len(ids) for ids in collections.values())
-            print(f"\n[SMART COLLECTIONS UPDATE] Retrieved {len(collections)} collections with {retrieved_total} products")
-
-            if not collections:
-                yield f"data: {json.dumps({'type': 'error', 'message': 'No classification data'})}\n\n"
-                return
-
-            if not shop_url or not access_token:
-                yield f"data: {json.dumps({'type': 'error', 'message': 'Missing credentials'})}\n\n"
-                return
-
-            # Deduplicate - each product in ONLY ONE collection
-            seen_products = set()
-            clean_collections = {}
-            duplicates_removed = 0
-
-            for collection_name, indices in collections.items():
-                unique_indices = []
-                for idx in indices:
-                    if idx not in seen_products:
-                        unique_indices.append(idx)
-                        seen_products.add(idx)
-                    else:
-                        duplicates_removed += 1
-
-                if unique_indices:
-                    clean_collections[collection_name] = unique_indices
-
-            collections = clean_collections
-
-            if duplicates_removed > 0:
-                yield f"data: {json.dumps({'type': 'info', 'message': f'Removed {duplicates_removed} duplicates (one product = one collection)'})}\n\n"
-
-            total_products = len(seen_products)
-            total_collections = len(collections)
-
-            yield f"data: {json.dumps({'type': 'start', 'total': total_products, 'collections': total_collections})}\n\n"
-            yield f"data: {json.dumps({'type': 'info', 'message': f'Step 1/2: Creating {total_collections} Smart Collections...'})}\n\n"
-
-            # STEP 1: Create Smart Collections (fast!)
-            collections_created = 0
-            for collection_name in collections.keys():
-                collections_created += 1
-
-                yield f"data: {json.dumps({'type': 'collection_start', 'name': collection_name, 'progress': f'{collections_created}/{total_collections}'})}\n\n"
-
-                # Create Smart Collection with rule
-                collection_id = create_or_get_smart_collection(collection_name, shop_url, headers)
-
-                if collection_id:
-                    yield f"data: {json.dumps({'type': 'collection_created', 'name': collection_name, 'id': collection_id})}\n\n"
-                else:
-                    yield f"data: {json.dumps({'type': 'collection_error', 'name': collection_name, 'message': 'Failed to create'})}\n\n"
-
-            yield f"data: {json.dumps({'type': 'info', 'message': f'Step 2/2: Updating {total_products} products...'})}\n\n"
-
-            # STEP 2: Update product metadata
-            success_count = 0
-            processed_count = 0
-
-            for collection_name, indices in collections.items():
-                for idx in indices:
-                    if 1 <= idx <= len(products):
-                        processed_count += 1
-                        product = products[idx - 1]
-
-                        # Stream updates every product
-                        if update_product_metadata(product["id"], collection_name, product["title"], shop_url, headers):
-                            success_count += 1
-                            yield f"data: {json.dumps({'type': 'product_updated', 'collection': collection_name, 'product': product['title'], 'progress': f'{processed_count}/{total_products}'})}\n\n"
-                        else:
-                            yield f"data: {json.dumps({'type': 'product_error', 'collection': collection_name, 'product': product['title']})}\n\n"
-
-            yield f"data: {json.dumps({'type': 'complete', 'success_count': success_count, 'total': total_products, 'collections': total_collections, 'message': 'Smart Collections will auto-populate! Check your Shopify store.'})}\n\n"
-
-        except PermissionError as e:
-            yield f"data: {json.dumps({'type': 'error', 'message': str(e), 'is_permission_error': True})}\n\n"
-        except Exception as e:
-            yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
-
-    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
-    response.headers['Cache-Control'] = 'no-cache'
-    response.headers['X-Accel-Buffering'] = 'no'
-    return response
-
-def create_or_get_smart_collection(collection_name, shop_url, headers):
-    """Create or get SMART collection with rules based on product_type"""
-    max_retries = 3
-
-    # Use stable API version compatible with most stores
-    api_version = '2024-10'
-
-    for attempt in range(max_retries):
-        try:
-            # Search for existing smart collection
-            search_url = f"https://{shop_url}/admin/api/{api_version}/smart_collections.json"
-            response = requests.get(search_url, headers=headers, timeout=30)
-
-            # Handle rate limiting
-            if response.status_code == 429:
-                retry_after = int(response.headers.get('Retry-After', 2))
-                print(f"Rate limit hit, waiting {retry_after} seconds...")
-                time.sleep(retry_after)
-                continue
-
-            response.raise_for_status()
-
-            search_data = response.json()
-            if "smart_collections" not in search_data:
-                print(f"Unexpected search response: {search_data}")
-                if "errors" in search_data:
-                    print(f"API Errors: {search_data['errors']}")
-                if attempt < max_retries - 1:
-                    time.sleep(2 * (attempt + 1))
-                    continue
-                return None
-
-            collections = search_data.get("smart_collections", [])
-            for col in collections:
-                if col["title"].lower() == collection_name.lower():
-                    print(f"✓ Found existing Smart Collection: {collection_name} (ID: {col['id']})")
-                    return col["id"]
-
-            # Create new SMART collection with rule: product_type equals collection_name
-            create_url = f"https://{shop_url}/admin/api/{api_version}/smart_collections.json"
-            payload = {
-                "smart_collection": {
-                    "title": collection_name,
-                    "published": True,
-                    "rules": [
-                        {
-                            "column": "type",  # product_type field
-                            "relation": "equals",
-                            "condition": collection_name  # Exact match
-                        }
-                    ],
-                    "disjunctive": False  # Must match all rules (only one rule, so strict match)
-                }
-            }
-
-            # Debug logging
-            print(f"\n[CREATE SMART COLLECTION]")
-            print(f"  Collection: {collection_name}")
-            print(f"  Rule: product_type EQUALS '{collection_name}'")
-
-            time.sleep(0.5)  # Rate limiting
-            response = requests.post(create_url, headers=headers, json=payload, timeout=30)
-
-            if response.status_code == 429:
-                retry_after = int(response.headers.get('Retry-After', 2))
-                print(f"Rate limit hit, waiting {retry_after} seconds...")
-                time.sleep(retry_after)
-                continue
-
-            response.raise_for_status()
-
-            response_data = response.json()
-            if "smart_collection" not in response_data:
-                print(f"Unexpected response creating Smart Collection {collection_name}")
-                print(f"Status: {response.status_code}, Response: {response.text[:500]}")
-
-                # Check if it's a permissions issue
-                if "errors" in response_data:
-                    error_msg = (
-                        f"PERMISSION ERROR: Cannot create Smart Collection '{collection_name}'. "
-                        f"Your Shopify API token is missing the 'write_collections' scope. "
-                        f"Please verify your app has read_products and write_products scopes."
-                    )
-                    print(f"ERROR: {error_msg}")
-                    raise PermissionError(error_msg)
-                if attempt < max_retries - 1:
-                    time.sleep(2 * (attempt + 1))
-                    continue
-                return None
-
-            collection_id = response_data["smart_collection"]["id"]
-            print(f"✓ Created Smart Collection: {collection_name} (ID: {collection_id})")
-            print(f"  → Auto-populates products with product_type = '{collection_name}'")
-            return collection_id
-
-        except requests.exceptions.Timeout:
-            print(f"Timeout creating Smart Collection {collection_name}, attempt {attempt + 1}/{max_retries}")
-            if attempt < max_retries - 1:
-                time.sleep(2 * (attempt + 1))
-                continue
-
-        except Exception as e:
-            print(f"Error creating/getting Smart Collection {collection_name}: {str(e)}")
-            if attempt < max_retries - 1:
-                time.sleep(2 * (attempt + 1))
-                continue
-
-    return None
-
-def update_product_metadata(product_id, collection_name, product_title, shop_url, headers):
-    """Update product with ONLY the collection name as tag (replaces all existing tags).
-    Also sets product_type to the exact collection name.
-    Smart Collections will auto-populate based on product_type match.
-
-    IMPORTANT: This replaces ALL existing tags with ONLY the collection name."""
-    max_retries = 3
-    retry_delay = 1  # seconds
-    api_version = '2024-10'
-
-    for attempt in range(max_retries):
-        try:
-            # Get current product data
-            product_url = f"https://{shop_url}/admin/api/{api_version}/products/{product_id}.json"
-            time.sleep(0.5)  # Rate limiting
-
-            get_response = requests.get(product_url, headers=headers, timeout=30)
-
-            if get_response.status_code == 429:
-                retry_after = int(get_response.headers.get('Retry-After', 2))
-                print(f"Rate limit hit while fetching product, waiting {retry_after} seconds...")
-                time.sleep(retry_after)
-                continue
-
-            get_response.raise_for_status()
-            product_data = get_response.json().get('product', {})
-
-            # CRITICAL: Set ONLY the collection name as the tag (replace all existing tags)
-            # Each product gets ONLY ONE tag = the exact collection name
-            updated_tags = collection_name
-
-            # CRITICAL: Set product_type to EXACT collection name
-            # This is what Smart Collections will match against!
-            product_type_value = collection_name
-
-            # Update product with exact collection name as both tag and type
-            update_payload = {
-                "product": {
-                    "id": product_id,
-                    "tags": updated_tags,
-                    "product_type": product_type_value  # EXACT match for Smart Collection rule
-                }
-            }
-
-            time.sleep(0.5)  # Rate limiting
-            update_response = requests.put(product_url, headers=headers, json=update_payload, timeout=30)
-
-            if update_response.status_code == 429:
-                retry_after = int(update_response.headers.get('Retry-After', 2))
-                print(f"Rate limit hit while updating product, waiting {retry_after} seconds...")
-                time.sleep(retry_after)
-                continue
-
-            update_response.raise_for_status()
-            print(f"✓ '{product_title[:50]}...' → tag = '{collection_name}' | product_type = '{product_type_value}'")
-
-            return True
-
-        except requests.exceptions.Timeout:
-            print(f"Timeout updating product {product_id}, attempt {attempt + 1}/{max_retries}")
-            if attempt < max_retries - 1:
-                time.sleep(retry_delay * (attempt + 1))
-                continue
-            return False
-
-        except requests.exceptions.RequestException as e:
-            print(f"Error updating product {product_id}: {str(e)}")
-            if attempt < max_retries - 1:
-                time.sleep(retry_delay * (attempt + 1))
-                continue
-            return False
-
-        except Exception as e:
-            print(f"Unexpected error updating product {product_id}: {str(e)}")
-            return False
-
-    return False
-
-if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
+from flask import Flask, render_template, request, jsonify, session, Response, stream_with_context
+from flask.json.provider import JSONProvider
+import requests
+import openai
+import atexit
+import hashlib
+import heapq
+import json
+import logging
+import numpy as np
+import orjson
+import os
+import queue
+import sys
+import time
+import uuid
+import re
+from datetime import timedelta, datetime
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
+from dotenv import load_dotenv
+from threading import Condition, Lock
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from urllib3.util.retry import Retry
+
+try:
+    import ijson  # optional: stream-parse product pages instead of loading them whole
+except ImportError:
+    ijson = None
+
+# Load environment variables
+load_dotenv()
+
+# The Shopify update path logs through a queue drained by a background thread, so a
+# slow stdout never holds up the thread producing the next SSE frame
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.propagate = False
+logger.addHandler(QueueHandler(log_queue))
+log_listener.start()
+atexit.register(log_listener.stop)
+
+class OrjsonProvider(JSONProvider):
+    """Serve jsonify() responses with orjson instead of the stdlib encoder"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+def sse_event(obj):
+    """One Server-Sent Events frame, already UTF-8 encoded so the stream passes it through as-is"""
+    return b"data: " + orjson.dumps(obj) + b"\n\n"
+
+# Proxies drop connections that stay silent too long, so quiet streams send a comment this often
+SSE_KEEPALIVE_INTERVAL = 15
+SSE_KEEPALIVE = b": keepalive\n\n"
+
+def sse_response(stream):
+    """Wrap an SSE generator in a response that proxies pass through unbuffered"""
+    response = Response(stream_with_context(stream), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def as_completed_with_keepalive(futures, interval=SSE_KEEPALIVE_INTERVAL):
+    """Like as_completed(), but yields None whenever `interval` seconds pass without a result"""
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, timeout=interval, return_when=FIRST_COMPLETED)
+        if not done:
+            yield None
+        yield from done
+
+app = Flask(__name__)
+app.json = OrjsonProvider(app)
+app.secret_key = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
+app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=24)
+
+# Get OpenAI key from environment
+OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
+
+# Max concurrent OpenAI classification requests per job
+OPENAI_MAX_WORKERS = int(os.environ.get('OPENAI_MAX_WORKERS', 10))
+
+# Configure the OpenAI SDK once. It opens a session per thread - and closes and reopens it
+# every 180s - while the per-job pool threads are new each time, so every session it makes
+# mounts one shared keep-alive pool sized for the workers, with the SDK's 2 connection retries
+openai.api_key = OPENAI_API_KEY
+
+class SharedHTTPAdapter(HTTPAdapter):
+    """Adapter mounted on several sessions - closing one of them must not drop the pool the rest use"""
+
+    def close(self):
+        pass
+
+OPENAI_ADAPTER = SharedHTTPAdapter(pool_connections=1, pool_maxsize=OPENAI_MAX_WORKERS, max_retries=2)
+
+def make_openai_session():
+    """Thin session over OPENAI_ADAPTER - the SDK calls this factory for each thread's session"""
+    session = requests.Session()
+    session.mount('https://', OPENAI_ADAPTER)
+    session.hooks["response"].append(sync_openai_limits)
+    return session
+
+openai.requestssession = make_openai_session
+
+# Product titles packed into one classification chat completion
+CLASSIFY_CHUNK_SIZE = int(os.environ.get('CLASSIFY_CHUNK_SIZE', 25))
+
+# Embedding model for nearest-collection matching, and the cosine score below which
+# a title is sent to the chat model instead
+EMBEDDING_MODEL = os.environ.get('EMBEDDING_MODEL', 'text-embedding-3-small')
+EMBEDDING_MIN_SCORE = float(os.environ.get('EMBEDDING_MIN_SCORE', 0.35))
+
+# Titles whose embedding scores at least this close to an already-classified title reuse
+# its answer instead of asking the chat model ("Red 500mm Cone" vs "500mm Red Cone") - as
+# do near-identical titles within the same job.
+# 0 turns the semantic cache off
+SEMANTIC_CACHE_MIN_SCORE = float(os.environ.get('SEMANTIC_CACHE_MIN_SCORE', 0))
+
+# OpenAI account rate limits (see platform.openai.com/account/limits) - requests are paced to stay under them
+OPENAI_REQUESTS_PER_MINUTE = int(os.environ.get('OPENAI_REQUESTS_PER_MINUTE', 3500))
+OPENAI_TOKENS_PER_MINUTE = int(os.environ.get('OPENAI_TOKENS_PER_MINUTE', 90000))
+
+# /api/classify sends catalogs larger than this to the OpenAI Batch API (24h turnaround, half price)
+OPENAI_BATCH_THRESHOLD = int(os.environ.get('OPENAI_BATCH_THRESHOLD', 1000))
+
+# Max classification / Shopify update jobs running at once per process - more wait their turn
+BACKGROUND_MAX_JOBS = int(os.environ.get('BACKGROUND_MAX_JOBS', 4))
+
+# Max concurrent Shopify product updates per job
+SHOPIFY_MAX_WORKERS = int(os.environ.get('SHOPIFY_MAX_WORKERS', 8))
+
+# Jobs updating at least this many products use one Shopify bulk operation instead of per-product PUTs
+SHOPIFY_BULK_THRESHOLD = int(os.environ.get('SHOPIFY_BULK_THRESHOLD', 250))
+
+# Seconds to wait on a bulk operation before cancelling it and falling back - the product
+# export runs inside the /api/fetch-products request, so it must finish well inside gunicorn's timeout
+SHOPIFY_BULK_FETCH_TIMEOUT = float(os.environ.get('SHOPIFY_BULK_FETCH_TIMEOUT', 45))
+SHOPIFY_BULK_UPDATE_TIMEOUT = float(os.environ.get('SHOPIFY_BULK_UPDATE_TIMEOUT', 900))
+
+# Admin API version for every Shopify REST and GraphQL call
+SHOPIFY_API_VERSION = '2024-10'
+
+# Shopify REST leaky bucket: 40 request burst, leaking 2 requests/sec (Plus stores: 80 and 4/sec)
+SHOPIFY_BUCKET_SIZE = int(os.environ.get('SHOPIFY_BUCKET_SIZE', 40))
+SHOPIFY_REQUESTS_PER_SECOND = float(os.environ.get('SHOPIFY_REQUESTS_PER_SECOND', 2))
+
+# Shopify GraphQL cost bucket: 1000 points, restoring 50 points/sec (Plus stores: 2000 and 100/sec).
+# Smaller jobs update SHOPIFY_GRAPHQL_BATCH_SIZE products per request as aliased productUpdate
+# mutations (10 points each), paced against this bucket
+SHOPIFY_GRAPHQL_BUCKET_SIZE = int(os.environ.get('SHOPIFY_GRAPHQL_BUCKET_SIZE', 1000))
+SHOPIFY_GRAPHQL_RESTORE_RATE = float(os.environ.get('SHOPIFY_GRAPHQL_RESTORE_RATE', 50))
+SHOPIFY_GRAPHQL_BATCH_SIZE = int(os.environ.get('SHOPIFY_GRAPHQL_BATCH_SIZE', 10))
+
+# Shared HTTP session for all Shopify calls - reuses keep-alive connections instead of
+# a new TCP+TLS handshake per request. Idempotent requests retry on 5xx; 429s are left to the
+# callers, which cool the shop's rate limiter down for Retry-After (see shopify_get) so every
+# worker backs off - not just the one thread urllib3 would have slept.
+# Each shop's pool keeps a connection for every update worker of every running job, so
+# connections aren't dropped and re-opened when the pool overflows. Pools are kept for up
+# to 100 hosts (shops plus the bulk-operation upload/download hosts) - with urllib3's
+# default of 10, a busy worker serving many shops evicted pools and re-did the TLS handshakes
+SHOPIFY_SESSION = requests.Session()
+SHOPIFY_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=100,
+    pool_maxsize=max(20, SHOPIFY_MAX_WORKERS * BACKGROUND_MAX_JOBS),
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[500, 502, 503, 504],
+        allowed_methods=['GET', 'PUT'],
+        raise_on_status=False
+    )
+))
+
+# In-memory data store (backup solution for large data)
+# This avoids cookie size limits completely. Sessions are spread over
+# STORE_SHARDS dicts by session id so concurrent requests from different
+# sessions don't wait on one lock; each shard is (sessions, lock, expiry heap)
+STORE_SHARDS = 16
+store_shards = [({}, Lock(), []) for _ in range(STORE_SHARDS)]
+
+# Set REDIS_URL to share sessions across Gunicorn workers - keys expire in Redis after SESSION_TTL
+REDIS_URL = os.environ.get('REDIS_URL')
+SESSION_TTL = 86400
+
+if REDIS_URL:
+    import redis
+    import msgpack
+    redis_client = redis.Redis(connection_pool=redis.ConnectionPool.from_url(REDIS_URL))
+else:
+    redis_client = None
+
+def get_store_shard(sid):
+    """Return the (sessions, lock, expiry heap) shard holding this session"""
+    return store_shards[hash(sid) % STORE_SHARDS]
+
+def cleanup_old_sessions(shard):
+    """Remove sessions older than 24 hours from a shard (caller holds its lock)
+
+    Only the already-expired front of the shard's heap is touched, so each
+    write pays for the sessions that actually expired rather than a full scan.
+    """
+    sessions, _, expiry = shard
+    now = time.time()
+    cutoff = datetime.now() - timedelta(seconds=SESSION_TTL)
+    while expiry and expiry[0][0] <= now:
+        _, sid = heapq.heappop(expiry)
+        # get_data may already have dropped it and a new session taken the id
+        data = sessions.get(sid)
+        if data is not None and data['created_at'] <= cutoff:
+            del sessions[sid]
+            
+def get_session_id():
+    """Get or create session ID"""
+    if 'session_id' not in session:
+        session['session_id'] = str(uuid.uuid4())
+        session.permanent = True
+    return session['session_id']
+
+def store_data(key, value, sid=None):
+    """Store data in Redis or the memory store (sid is required outside a request)"""
+    store_many({key: value}, sid=sid)
+
+def store_many(values, sid=None):
+    """Store several keys at once, so readers never see half of an update
+
+    In Redis each session is one hash; the fields and the TTL refresh go in
+    a single MULTI/EXEC transaction.
+    """
+    sid = sid or get_session_id()
+    if redis_client:
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.hset(f"sess:{sid}", mapping={k: msgpack.packb(v) for k, v in values.items()})
+        pipe.expire(f"sess:{sid}", SESSION_TTL)
+        pipe.execute()
+        return
+    shard = get_store_shard(sid)
+    sessions, lock, expiry = shard
+    with lock:
+        cleanup_old_sessions(shard)
+        if sid not in sessions:
+            sessions[sid] = {'created_at': datetime.now()}
+            heapq.heappush(expiry, (time.time() + SESSION_TTL, sid))
+        sessions[sid].update(values)
+        
+def get_data(key, default=None, sid=None):
+    """Retrieve data from Redis or the memory store"""
+    return get_many({key: default}, sid=sid)[0]
+
+def get_many(defaults, sid=None):
+    """Retrieve several keys in one read; returns values in the order of defaults"""
+    sid = sid or get_session_id()
+    if redis_client:
+        raws = redis_client.hmget(f"sess:{sid}", list(defaults))
+        return tuple(default if raw is None else msgpack.unpackb(raw, strict_map_key=False)
+                     for default, raw in zip(defaults.values(), raws))
+    sessions, lock, _ = get_store_shard(sid)
+    with lock:
+        data = sessions.get(sid)
+        # Expired sessions are dropped on read too, not just on the next write
+        if data is not None and datetime.now() - data['created_at'] > timedelta(seconds=SESSION_TTL):
+            del sessions[sid]
+            data = None
+        data = data or {}
+        return tuple(data.get(key, default) for key, default in defaults.items())
+
+if redis_client:
+    print(f"✓ Redis data store initialized (shared across workers)")
+    print(f"✓ Session cleanup: Redis key expiry (24 hours)")
+else:
+    print(f"✓ In-memory data store initialized (no cookie size limits)")
+    print(f"✓ Session cleanup: automatic (24 hour expiry)")
+
+# Background task manager
+classification_tasks = {}
+tasks_lock = Lock()
+tasks_changed = Condition(tasks_lock)  # notified on every progress update, for the task SSE stream
+TASK_FLUSH_INTERVAL = 1  # seconds between Redis writes of a running task's progress
+
+# Long-lived pool that runs the background jobs, so threads are reused rather than
+# started per request and a burst of jobs queues instead of all running at once
+background_jobs = ThreadPoolExecutor(max_workers=BACKGROUND_MAX_JOBS, thread_name_prefix='background-job')
+
+def get_task_id():
+    """Generate unique task ID"""
+    return str(uuid.uuid4())
+
+def update_task_progress(task_id, status, progress=0, message="", data=None):
+    """Update task progress and wake any task progress streams
+
+    With REDIS_URL set the task is mirrored to Redis so any worker can answer
+    status polls - written at most every TASK_FLUSH_INTERVAL seconds while it's
+    running, and always when it finishes."""
+    with tasks_changed:
+        if task_id not in classification_tasks:
+            classification_tasks[task_id] = {'version': 0, 'flushed_at': 0}
+        task = classification_tasks[task_id]
+        task.update({
+            'status': status,  # 'running', 'complete', 'error'
+            'progress': progress,  # 0-100
+            'message': message,
+            'updated_at': datetime.now(),
+            'data': data,
+            'version': task['version'] + 1
+        })
+        tasks_changed.notify_all()
+
+        flush = redis_client and (status != 'running' or time.monotonic() - task['flushed_at'] >= TASK_FLUSH_INTERVAL)
+        if flush:
+            task['flushed_at'] = time.monotonic()
+            snapshot = {key: task[key] for key in ('status', 'progress', 'message', 'data', 'version')}
+            snapshot['updated_at'] = task['updated_at'].isoformat()
+
+    if flush:
+        redis_client.setex(f"task:{task_id}", SESSION_TTL, msgpack.packb(snapshot))
+
+def get_task_status(task_id):
+    """Get task status - from this process, or the Redis copy of a task another worker runs"""
+    with tasks_lock:
+        task = classification_tasks.get(task_id, None)
+    if task is None and redis_client:
+        raw = redis_client.get(f"task:{task_id}")
+        if raw is not None:
+            task = msgpack.unpackb(raw, strict_map_key=False)
+            task['updated_at'] = datetime.fromisoformat(task['updated_at'])
+    return task
+
+class RateLimiter:
+    """Thread-safe token bucket - callers block only when the bucket is empty"""
+
+    def __init__(self, capacity, refill_rate):
+        self.capacity = capacity
+        self.refill_rate = refill_rate  # tokens per second
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = Lock()
+
+    def acquire(self, tokens=1):
+        """Take tokens from the bucket, sleeping until enough have refilled"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_rate)
+                self.updated_at = now
+
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+
+                wait = (tokens - self.tokens) / self.refill_rate
+
+            time.sleep(wait)
+
+    def observe(self, remaining):
+        """Never hold more tokens than the server says are left (other workers share the limit)"""
+        with self.lock:
+            self.tokens = min(self.tokens, remaining)
+
+    def cooldown(self, seconds):
+        """Server said slow down (429 Retry-After) - no caller gets through for `seconds`"""
+        with self.lock:
+            self.tokens = min(self.tokens, -seconds * self.refill_rate)
+
+# RateLimiter's refill + take, run atomically inside Redis against its own clock so every
+# worker sees the same bucket. ARGV: capacity, refill rate, operation, amount. Returns the
+# seconds to wait before trying again (0 when the tokens were taken), as a string because
+# Redis truncates Lua numbers to integers
+TOKEN_BUCKET_SCRIPT = """
+local capacity, refill_rate = tonumber(ARGV[1]), tonumber(ARGV[2])
+local op, amount = ARGV[3], tonumber(ARGV[4])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(state[1]) or capacity
+local updated_at = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * refill_rate)
+
+local wait = 0
+if op == 'acquire' then
+    if tokens >= amount then
+        tokens = tokens - amount
+    else
+        wait = (amount - tokens) / refill_rate
+    end
+elseif op == 'observe' then
+    tokens = math.min(tokens, amount)
+else
+    tokens = math.min(tokens, -amount * refill_rate)
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+-- A bucket left alone refills completely, so it can expire once it would be full again
+redis.call('PEXPIRE', KEYS[1], math.ceil((capacity - tokens) / refill_rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+class RedisRateLimiter:
+    """RateLimiter's token bucket kept in Redis, so every worker process draws on the same
+    per-key bucket - same capacity (burst) and refill rate; a 429 cooldown pauses all of them"""
+
+    def __init__(self, key, capacity, refill_rate):
+        self.key = f"rl:{key}"
+        self.capacity = capacity
+        self.refill_rate = refill_rate  # tokens per second, fractions allowed
+        self.script = redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def _run(self, op, amount):
+        return float(self.script(keys=[self.key], args=[self.capacity, self.refill_rate, op, amount]))
+
+    def acquire(self, tokens=1):
+        """Take tokens from the bucket, sleeping until enough have refilled"""
+        while True:
+            wait = self._run('acquire', tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def observe(self, remaining):
+        """Never hold more tokens than the server says are left (other apps share the limit)"""
+        self._run('observe', remaining)
+
+    def cooldown(self, seconds):
+        """Server said slow down (429 Retry-After) - no worker gets through for `seconds`"""
+        self._run('cooldown', seconds)
+
+def make_rate_limiter(key, capacity, refill_rate):
+    """Token bucket shared by every worker process through Redis when REDIS_URL is set,
+    otherwise kept in this process"""
+    if redis_client:
+        return RedisRateLimiter(key, capacity, refill_rate)
+    return RateLimiter(capacity, refill_rate)
+
+# OpenAI limits are per API key, so every job shares one request bucket and one token bucket
+openai_request_limiter = make_rate_limiter("openai:requests", OPENAI_REQUESTS_PER_MINUTE, OPENAI_REQUESTS_PER_MINUTE / 60)
+openai_token_limiter = make_rate_limiter("openai:tokens", OPENAI_TOKENS_PER_MINUTE, OPENAI_TOKENS_PER_MINUTE / 60)
+
+def sync_openai_limits(response, *args, **kwargs):
+    """Session response hook: pull the buckets down to OpenAI's x-ratelimit-remaining-* headers"""
+    for header, limiter in (("x-ratelimit-remaining-requests", openai_request_limiter),
+                            ("x-ratelimit-remaining-tokens", openai_token_limiter)):
+        remaining = response.headers.get(header)
+        if remaining is not None and remaining.isdigit():
+            limiter.observe(int(remaining))
+
+# For the REST calls the SDK doesn't cover (Batch API)
+OPENAI_SESSION = make_openai_session()
+
+def openai_chat(messages, max_tokens, **kwargs):
+    """openai.ChatCompletion.create, waiting first for request + token budget under the account limits"""
+    # ~4 characters per prompt token, plus the full completion budget
+    estimated_tokens = sum(len(m["content"]) for m in messages) // 4 + max_tokens
+    openai_request_limiter.acquire()
+    openai_token_limiter.acquire(min(estimated_tokens, OPENAI_TOKENS_PER_MINUTE))
+    return openai.ChatCompletion.create(messages=messages, max_tokens=max_tokens, **kwargs)
+
+# Markdown code fence around an AI reply, and trailing commas the model sometimes leaves in JSON
+CODE_FENCE_RE = re.compile(r'```(?:json)?\s*(.*?)\s*```', re.DOTALL)
+TRAILING_COMMA_RE = re.compile(r',\s*([}\]])')
+
+def extract_json_text(result):
+    """Strip code fences and trailing commas from an AI JSON reply"""
+    match = CODE_FENCE_RE.search(result)
+    if match:
+        result = match.group(1)
+    return TRAILING_COMMA_RE.sub(r'\1', result)
+
+def extract_json_object(result):
+    """extract_json_text, then cut any prose around the outermost {...}"""
+    result = extract_json_text(result)
+    start, end = result.find('{'), result.rfind('}')
+    return result[start:end + 1] if start != -1 and end > start else result.strip()
+
+def parse_hierarchy(reply):
+    """AI reply {"Parent": ["Sub", ...]} -> (["Parent > Sub", ...], {"Parent > Sub": "Parent"})"""
+    suggested_collections = []
+    parent_mapping = {}
+    for parent, subcategories in orjson.loads(extract_json_object(reply)).items():
+        for subcat in subcategories:
+            full_name = f"{parent} > {subcat}"
+            suggested_collections.append(full_name)
+            parent_mapping[full_name] = parent
+    return suggested_collections, parent_mapping
+
+# Extra instructions used by the /api/classify prompt
+DETAILED_CLASSIFY_GUIDANCE = """
+
+Consider:
+- Demographics: Men's/Women's/Kids'/Unisex
+- Style: Running/Casual/Formal/Athletic/Industrial/Professional
+- Type and specific features
+
+Be PRECISE and choose the most granular match."""
+
+# The collections list and instructions go in the system message and only the product
+# title(s) in the user message, so every request in a job starts with the same bytes and
+# OpenAI's automatic prompt caching can reuse the long prefix
+@lru_cache(maxsize=16)
+def classify_system_message(collections_list, guidance=""):
+    """System message for single-title requests - built once per job, shared, never modified"""
+    return {"role": "system", "content": f"""You are a product classification expert. Classify each product into the MOST SPECIFIC matching collection.
+
+Available collections (one per line, format "Parent > Subcategory"):
+{collections_list}
+
+Return ONLY the exact collection name (with " > " format) from the list above, nothing else. No explanation, just the collection name.{guidance}"""}
+
+@lru_cache(maxsize=16)
+def classify_chunk_system_message(collections_index, guidance=""):
+    """System message for numbered multi-title requests - built once per job, shared, never modified"""
+    return {"role": "system", "content": f"""You are a product classification expert. Classify each product into the MOST SPECIFIC matching collection.
+
+Available collections (number: "Parent > Subcategory"):
+{collections_index}
+
+Return ONLY a JSON array with one entry per product, like [{{"i": 1, "c": 0}}], where "i" is the product number and "c" is the collection number.{guidance}"""}
+
+# Answers already given for a title against a given collection list, kept per process
+# (oldest dropped past CLASSIFICATION_CACHE_SIZE) and in Redis for SESSION_TTL when REDIS_URL is set
+CLASSIFICATION_CACHE_SIZE = 10000
+classification_cache = {}
+classification_cache_lock = Lock()
+
+def classification_cache_key(product_title, fingerprint):
+    """Cache key for one title's answer; fingerprint changes whenever the collection list or prompt does"""
+    title_hash = hashlib.sha256(normalize_title(product_title).encode()).hexdigest()
+    return f"classify:{fingerprint}:{title_hash}"
+
+def get_cached_classifications(cache_keys):
+    """Collection name cached for each key, or None - one Redis MGET for all the local misses"""
+    with classification_cache_lock:
+        collection_names = [classification_cache.get(cache_key) for cache_key in cache_keys]
+    missing = [i for i, collection_name in enumerate(collection_names) if collection_name is None]
+    if missing and redis_client:
+        found = {}
+        for i, raw in zip(missing, redis_client.mget([cache_keys[i] for i in missing])):
+            if raw is not None:
+                collection_names[i] = found[cache_keys[i]] = raw.decode()
+        if found:
+            with classification_cache_lock:
+                classification_cache.update(found)
+    return collection_names
+
+def cache_classifications(answers):
+    """Remember valid answers ({cache_key: collection_name}) for later jobs - and, with Redis,
+    for other workers, written in one pipelined round trip"""
+    if not answers:
+        return
+    with classification_cache_lock:
+        for cache_key, collection_name in answers.items():
+            if len(classification_cache) >= CLASSIFICATION_CACHE_SIZE:
+                del classification_cache[next(iter(classification_cache))]
+            classification_cache[cache_key] = collection_name
+    if redis_client:
+        pipe = redis_client.pipeline(transaction=False)
+        for cache_key, collection_name in answers.items():
+            pipe.set(cache_key, collection_name, ex=SESSION_TTL)
+        pipe.execute()
+
+# Embeddings of titles the chat model has answered, per collection-list fingerprint:
+# {fingerprint: (L2-normalized vectors, [collection_name per row])}, in process only
+SEMANTIC_CACHE_LISTS = 16
+semantic_cache = {}
+
+def semantic_cache_lookup(fingerprint, vectors, min_score=None):
+    """Collection name of the nearest cached title for each vector row, or None below min_score"""
+    min_score = SEMANTIC_CACHE_MIN_SCORE if min_score is None else min_score
+    vectors = np.asarray(vectors)
+    with classification_cache_lock:
+        cached_vectors, cached_names = semantic_cache.get(fingerprint, (None, None))
+    if cached_vectors is None:
+        return [None] * len(vectors)
+
+    scores = vectors @ cached_vectors.T
+    best = scores.argmax(axis=1)
+    best_scores = scores[np.arange(len(vectors)), best]
+    return [cached_names[c] if score >= min_score else None for c, score in zip(best, best_scores)]
+
+def semantic_cache_add(fingerprint, vectors, collection_names):
+    """Remember answered titles' embeddings, dropping the oldest past CLASSIFICATION_CACHE_SIZE"""
+    vectors = np.asarray(vectors)
+    with classification_cache_lock:
+        cached_vectors, cached_names = semantic_cache.pop(fingerprint, (None, []))
+        if cached_vectors is not None:
+            vectors = np.vstack([cached_vectors, vectors])
+        names = (cached_names + list(collection_names))[-CLASSIFICATION_CACHE_SIZE:]
+        if len(semantic_cache) >= SEMANTIC_CACHE_LISTS:
+            del semantic_cache[next(iter(semantic_cache))]
+        semantic_cache[fingerprint] = (vectors[-CLASSIFICATION_CACHE_SIZE:], names)
+
+def near_duplicate_leaders(vectors, min_score=None):
+    """Row of the first earlier vector scoring at least min_score against each row, or the row itself"""
+    min_score = SEMANTIC_CACHE_MIN_SCORE if min_score is None else min_score
+    vectors = np.asarray(vectors)
+    leader_rows = []
+    leaders = []
+    for row, vector in enumerate(vectors):
+        if leader_rows:
+            scores = vectors[leader_rows] @ vector
+            best = scores.argmax()
+            if scores[best] >= min_score:
+                leaders.append(leader_rows[best])
+                continue
+        leader_rows.append(row)
+        leaders.append(row)
+    return leaders
+
+def get_parent_mapping(collection_names):
+    """Map each "Parent > Sub" collection to its parent; flat names are left out"""
+    return {name: parent for name in collection_names
+            for parent, sep, _ in [name.partition(" > ")] if sep}
+
+def index_collections(collection_names):
+    """Number the collections once per job ("0: Parent > Sub") so replies can name one by index"""
+    return "\n".join(f"{i}: {name}" for i, name in enumerate(collection_names))
+
+def classify_title_chunk(titles, collection_names, collections_index, guidance="", max_retries=3):
+    """Classify several (index, title) pairs with ONE chat completion (raises on API errors).
+
+    collections_index is index_collections(collection_names). Returns
+    {index: collection_name} for every product the reply covered."""
+    numbered = "\n".join(f"{n}. {title}" for n, (_, title) in enumerate(titles, 1))
+    messages = [classify_chunk_system_message(collections_index, guidance), {"role": "user", "content": f"Products:\n{numbered}"}]
+
+    for attempt in range(max_retries):
+        try:
+            resp = openai_chat(
+                model="gpt-3.5-turbo",
+                messages=messages,
+                temperature=0.1,
+                max_tokens=15 * len(titles) + 50,
+                request_timeout=120
+            )
+            break
+        except openai.error.RateLimitError:
+            # Concurrent workers can trip the rate limit - back off and retry
+            if attempt == max_retries - 1:
+                raise
+            time.sleep(2 ** attempt)
+
+    rows = orjson.loads(extract_json_text(resp.choices[0].message.content.strip()))
+    if isinstance(rows, dict):  # {"1": 0} instead of the requested array
+        rows = [{"i": n, "c": c} for n, c in rows.items()]
+
+    results = {}
+    for row in rows:
+        try:
+            n, c = int(row["i"]), int(row["c"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if 1 <= n <= len(titles) and 0 <= c < len(collection_names):
+            results[titles[n - 1][0]] = collection_names[c]
+    return results
+
+def classify_titles_chunked(titles, collection_names, guidance="", chunk_size=None, max_workers=None):
+    """Classify (index, title) pairs CLASSIFY_CHUNK_SIZE to a request, up to max_workers in flight.
+
+    The collections list is sent once per chunk rather than once per title, and
+    titles answered before against the same list come from the cache - or, with
+    SEMANTIC_CACHE_MIN_SCORE set, from a near-identical cached title. Near-identical
+    titles within the job are sent once and share the answer. Yields
+    (index, collection_name, error) for every title as its chunk finishes;
+    collection_name is None when the chunk failed or its reply skipped the title."""
+    chunk_size = chunk_size or CLASSIFY_CHUNK_SIZE
+    collections_index = index_collections(collection_names)
+    fingerprint = hashlib.sha256((collections_index + guidance).encode()).hexdigest()[:16]
+    cache_keys = {idx: classification_cache_key(title, fingerprint) for idx, title in titles}
+
+    # One cache round trip per chunk of titles rather than one per title
+    titles_left = []
+    for start in range(0, len(titles), chunk_size):
+        chunk = titles[start:start + chunk_size]
+        for (idx, title), collection_name in zip(chunk, get_cached_classifications([cache_keys[idx] for idx, _ in chunk])):
+            if collection_name is None:
+                titles_left.append((idx, title))
+            else:
+                yield idx, collection_name, None
+
+    title_vectors = {}
+    followers = {}
+    if SEMANTIC_CACHE_MIN_SCORE and titles_left:
+        try:
+            vectors = [row for start in range(0, len(titles_left), 2048)
+                       for row in embed_texts([title for _, title in titles_left[start:start + 2048]])]
+        except Exception as e:
+            print(f"Semantic cache skipped, embedding failed: {str(e)[:100]}")
+        else:
+            neighbours = semantic_cache_lookup(fingerprint, vectors)
+            unmatched = []
+            matched = {}
+            for (idx, title), vector, collection_name in zip(titles_left, vectors, neighbours):
+                if collection_name is None:
+                    title_vectors[idx] = vector
+                    unmatched.append((idx, title))
+                else:
+                    matched[idx] = collection_name
+            cache_classifications({cache_keys[idx]: collection_name for idx, collection_name in matched.items()})
+            for idx, collection_name in matched.items():
+                yield idx, collection_name, None
+
+            # Near-identical titles in this job ride along with the first of them
+            titles_left = []
+            leaders = near_duplicate_leaders([title_vectors[idx] for idx, _ in unmatched])
+            for (idx, title), leader in zip(unmatched, leaders):
+                if unmatched[leader][0] == idx:
+                    titles_left.append((idx, title))
+                else:
+                    followers.setdefault(unmatched[leader][0], []).append(idx)
+            if followers:
+                print(f"  {len(unmatched) - len(titles_left)} near-identical titles will reuse another title's answer")
+
+    chunks = [titles_left[start:start + chunk_size] for start in range(0, len(titles_left), chunk_size)]
+
+    executor = ThreadPoolExecutor(max_workers=max_workers or OPENAI_MAX_WORKERS)
+    try:
+        futures = {executor.submit(classify_title_chunk, chunk, collection_names, collections_index, guidance): chunk
+                   for chunk in chunks}
+        for future in as_completed(futures):
+            chunk = futures[future]
+            try:
+                answers, error = future.result(), None
+            except Exception as e:
+                print(f"Chunk {chunk[0][0]}-{chunk[-1][0]} failed, using fallback: {str(e)[:100]}")
+                answers, error = {}, e
+            if title_vectors and answers:
+                semantic_cache_add(fingerprint, [title_vectors[idx] for idx in answers], answers.values())
+            answers.update((follower, collection_name) for idx, collection_name in list(answers.items())
+                           for follower in followers.get(idx, ()))
+            cache_classifications({cache_keys[idx]: collection_name for idx, collection_name in answers.items()})
+            for idx, _ in chunk:
+                yield idx, answers.get(idx), error
+                for follower in followers.get(idx, ()):
+                    yield follower, answers.get(follower), error
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def embed_texts(texts):
+    """Embed up to 2048 texts in one request; returns L2-normalized vectors as a numpy matrix"""
+    resp = openai.Embedding.create(model=EMBEDDING_MODEL, input=texts)
+    vectors = np.array([row["embedding"] for row in sorted(resp["data"], key=lambda row: row["index"])])
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+@lru_cache(maxsize=16)
+def embed_collection_names(collection_names):
+    """Embedding matrix for a tuple of collection names - computed once per collection list, not per job"""
+    return embed_texts(list(collection_names))
+
+def classify_titles_by_embedding(titles, collection_names, min_score=None, chunk_size=2048):
+    """Match (index, title) pairs to the collection name with the most similar embedding.
+
+    Returns ({index: collection_name} for confident matches, [(index, title)] scoring
+    below min_score, left for the chat model)."""
+    min_score = EMBEDDING_MIN_SCORE if min_score is None else min_score
+    collection_vectors = embed_collection_names(tuple(collection_names))
+    matched = {}
+    unsure = []
+
+    for start in range(0, len(titles), chunk_size):
+        chunk = titles[start:start + chunk_size]
+        scores = embed_texts([title for _, title in chunk]) @ collection_vectors.T
+        best = scores.argmax(axis=1)
+        best_scores = scores[np.arange(len(chunk)), best]
+
+        for (idx, title), c, score in zip(chunk, best, best_scores):
+            if score >= min_score:
+                matched[idx] = collection_names[c]
+            else:
+                unsure.append((idx, title))
+
+    return matched, unsure
+
+def normalize_title(title):
+    """Key for spotting repeated titles - case and spacing differences don't change the answer"""
+    return " ".join(title.lower().split())
+
+def dedupe_titles(titles):
+    """Keep one (index, title) per distinct normalized title.
+
+    Returns (unique, groups) where groups maps each kept index to every index
+    sharing its title, for fan_out_results()."""
+    titles = list(titles)
+    first_index = {}
+    groups = {}
+    for idx, title in titles:
+        key = normalize_title(title)
+        if key in first_index:
+            groups[first_index[key]].append(idx)
+        else:
+            first_index[key] = idx
+            groups[idx] = [idx]
+
+    unique = [(idx, title) for idx, title in titles if idx in groups]
+    return unique, groups
+
+def sample_distinct_titles(titles, limit=200):
+    """First `limit` distinct titles, so the hierarchy prompt isn't a run of near-identical SKUs"""
+    seen = set()
+    sample = []
+    for title in titles:
+        key = normalize_title(title)
+        if key not in seen:
+            seen.add(key)
+            sample.append(title)
+            if len(sample) >= limit:
+                break
+    return sample
+
+def fan_out_results(results, groups):
+    """Copy each unique title's {index: result} to every product sharing that title"""
+    return {member: results[idx] for idx, members in groups.items() if idx in results for member in members}
+
+# Reported when the AI hierarchy or the user's list comes back with no collections at all
+NO_COLLECTIONS_ERROR = "No collections to classify products into - the collection list is empty"
+
+def assign_classifications(results, collection_names, total_products):
+    """Turn {index: (collection_name, error)} into {collection: [indices]}, in product order.
+
+    Products with an invalid answer, a failed request or no result at all go to
+    the most populated collection. Returns (collections_dict, product_to_collection)."""
+    if not collection_names:
+        raise ValueError(NO_COLLECTIONS_ERROR)
+    counts = dict.fromkeys(collection_names, 0)
+    name_ids = {name: i for i, name in enumerate(counts)}
+    product_to_collection = {}
+    assignments = np.empty(total_products, dtype=np.int32)
+    # Running most-populated collection, so a fallback doesn't rescan every collection
+    max_name, max_count = next(iter(counts), None), 0
+
+    for idx in range(1, total_products + 1):
+        collection_name, error = results.get(idx, (None, None))
+
+        # Validate collection exists
+        if collection_name not in counts:
+            # Fallback to most populated collection
+            collection_name = max_name
+            if error is not None:
+                if idx % 100 == 0:  # Only log occasionally
+                    print(f"    ⚠️ Error on product {idx}, using fallback: {str(error)[:50]}")
+            elif idx % 50 == 0:  # Only log occasionally to reduce noise
+                print(f"    ⚠️ Product {idx} got invalid collection, using fallback")
+
+        product_to_collection[idx] = collection_name
+        assignments[idx - 1] = name_ids[collection_name]
+        counts[collection_name] += 1
+        if counts[collection_name] > max_count:
+            max_name, max_count = collection_name, counts[collection_name]
+
+    # Group in one vectorized pass: a stable sort by collection keeps product order
+    # within each collection, and the counts say where each collection's run ends
+    order = np.argsort(assignments, kind='stable') + 1
+    bounds = np.cumsum(list(counts.values()))[:-1]
+    collections_dict = {name: group.tolist() for name, group in zip(counts, np.split(order, bounds))}
+
+    return collections_dict, product_to_collection
+
+def openai_request(method, path, **kwargs):
+    """Call an OpenAI REST endpoint the pinned SDK doesn't wrap (Batch API, batch files)"""
+    response = OPENAI_SESSION.request(method, f"https://api.openai.com/v1{path}",
+                                      headers={"Authorization": f"Bearer {OPENAI_API_KEY}"}, timeout=120, **kwargs)
+    response.raise_for_status()
+    return response
+
+def submit_classification_batch(titles, collections_list, guidance=""):
+    """Submit one classification request per (index, title) to the OpenAI Batch API.
+
+    Batches finish within 24h at half the token price. Returns the batch ID."""
+    # Only the custom_id and the title change from line to line - serialize the
+    # (large) system message and the rest of the request once, not once per title
+    system_json = orjson.dumps(classify_system_message(collections_list, guidance)).decode()
+    line_middle = ('", "method": "POST", "url": "/v1/chat/completions", "body": {"model": "gpt-3.5-turbo", '
+                   f'"temperature": 0.1, "max_tokens": 100, "messages": [{system_json}, ')
+    lines = [f'{{"custom_id": "{idx}{line_middle}{orjson.dumps({"role": "user", "content": f"Product: {title}"}).decode()}]}}}}'
+             for idx, title in titles]
+
+    upload = openai_request("post", "/files", data={"purpose": "batch"},
+                            files={"file": ("classification.jsonl", "\n".join(lines).encode("utf-8"))}).json()
+    batch = openai_request("post", "/batches", json={
+        "input_file_id": upload["id"],
+        "endpoint": "/v1/chat/completions",
+        "completion_window": "24h"
+    }).json()
+
+    print(f"[BATCH] Submitted {batch['id']} with {len(lines)} classification requests")
+    return batch["id"]
+
+def read_classification_batch(batch):
+    """Download a completed batch's output as {index: (collection_name, error)}"""
+    results = {}
+
+    if batch.get("output_file_id"):
+        output = openai_request("get", f"/files/{batch['output_file_id']}/content")
+        for line in output.text.splitlines():
+            row = orjson.loads(line)
+            idx = int(row["custom_id"])
+            body = (row.get("response") or {}).get("body") or {}
+            if row.get("error") or not body.get("choices"):
+                results[idx] = (None, row.get("error") or "empty response")
+            else:
+                results[idx] = (body["choices"][0]["message"]["content"].strip().strip('"\''), None)
+
+    return results
+
+def run_classification_batch_api(task_id, titles, collections_list, poll_interval=30):
+    """Classify (index, title) pairs through the OpenAI Batch API, reporting progress until it finishes.
+
+    Returns {index: (collection_name, error)} like read_classification_batch."""
+    batch_id = submit_classification_batch(titles, collections_list)
+    update_task_progress(task_id, 'running', 10, f'Submitted batch {batch_id} ({len(titles)} products)')
+
+    while True:
+        time.sleep(poll_interval)
+        batch = openai_request("get", f"/batches/{batch_id}").json()
+        status = batch["status"]
+
+        if status == "completed":
+            return read_classification_batch(batch)
+        if status in ("failed", "expired", "cancelled"):
+            raise Exception(f"Batch {batch_id} {status}")
+
+        counts = batch.get("request_counts") or {}
+        done = counts.get("completed", 0) + counts.get("failed", 0)
+        update_task_progress(task_id, 'running', 10 + int((done / len(titles)) * 85),
+                           f'Batch {status}: {done}/{len(titles)} products')
+
+def run_classification_background(task_id, product_titles, user_collections, session_id, use_batch_api=False, use_embeddings=False):
+    """Run classification in background thread
+
+    use_batch_api: OpenAI Batch API, half price, up to 24h.
+    use_embeddings: nearest collection by embedding, chat model only for low-confidence titles."""
+    try:
+        update_task_progress(task_id, 'running', 0, 'Starting classification...')
+
+        if not OPENAI_API_KEY:
+            update_task_progress(task_id, 'error', 0, 'OpenAI API key not configured')
+            return
+
+        total_products = len(product_titles)
+
+        # Step 1: Handle collections
+        if user_collections and len(user_collections) > 0:
+            suggested_collections = user_collections
+            update_task_progress(task_id, 'running', 5, f'Using {len(user_collections)} custom collections')
+
+            parent_mapping = get_parent_mapping(suggested_collections)
+
+            # Store parent mapping in session
+            store_data('parent_mapping', parent_mapping, sid=session_id)
+        else:
+            # Generate collections with AI
+            update_task_progress(task_id, 'running', 5, 'Generating collections with AI...')
+
+            # Reduce sample size to avoid token limits (16K for gpt-3.5-turbo-16k)
+            sample_titles = sample_distinct_titles(product_titles)
+            sample_count = len(sample_titles)
+            all_titles = "\n".join(f"{i}. {title}" for i, title in enumerate(sample_titles, 1))
+
+            collection_prompt = f"""You are analyzing {sample_count} construction/safety/traffic equipment products (sample from {total_products} total). Create a HIGHLY DETAILED collection structure with MANY specific subcategories.
+
+CRITICAL REQUIREMENTS:
+1. Create 8-15 PARENT categories based on main product types
+2. For EACH parent, create 10-30 SPECIFIC subcategories
+3. Target: 80-200+ total subcategories (the more specific, the better!)
+
+Products to analyze:
+{all_titles}
+
+Return a JSON object with parent categories as keys, and arrays of specific subcategories as values."""
+
+            try:
+                response = openai_chat(
+                    model="gpt-3.5-turbo-16k",
+                    messages=[
+                        {"role": "system", "content": "You are an expert categorization specialist. Return ONLY valid JSON."},
+                        {"role": "user", "content": collection_prompt}
+                    ],
+                    temperature=0.3,
+                    max_tokens=4000,
+                    request_timeout=180
+                )
+
+                suggested_collections, parent_mapping = parse_hierarchy(response.choices[0].message.content)
+
+                # Store in session
+                store_data('parent_mapping', parent_mapping, sid=session_id)
+
+                update_task_progress(task_id, 'running', 10, f'Generated {len(suggested_collections)} collections')
+
+            except Exception as e:
+                update_task_progress(task_id, 'error', 0, f'AI generation failed: {str(e)}')
+                return
+
+        # Step 2: Classify products - CLASSIFY_CHUNK_SIZE titles per request (the collections
+        # list is sent once per chunk), up to OPENAI_MAX_WORKERS requests in flight
+        collection_names = list(dict.fromkeys(suggested_collections))
+        if not collection_names:
+            update_task_progress(task_id, 'error', 0, NO_COLLECTIONS_ERROR)
+            return
+        collections_list = "\n".join(f"- {name}" for name in collection_names)
+
+        # Repeated titles (same product, different SKU) are classified once and fanned back out
+        titles, title_groups = dedupe_titles(enumerate(product_titles, 1))
+
+        if use_batch_api:
+            results = run_classification_batch_api(task_id, titles, collections_list)
+        else:
+            results = {}
+            titles_left = titles
+
+            if use_embeddings:
+                matched, titles_left = classify_titles_by_embedding(titles, collection_names)
+                results.update((idx, (collection_name, None)) for idx, collection_name in matched.items())
+                update_task_progress(task_id, 'running', 10 + int((len(results) / len(titles)) * 85),
+                                   f'Embeddings matched {len(matched)}/{len(titles)} titles, {len(titles_left)} left for the chat model')
+
+            update_task_progress(task_id, 'running', 10 + int((len(results) / len(titles)) * 85),
+                               f'Processing {len(titles_left)} unique titles in requests of {CLASSIFY_CHUNK_SIZE}')
+
+            for idx, collection_name, error in classify_titles_chunked(titles_left, collection_names):
+                results[idx] = (collection_name, error)
+
+                # Progress once per finished chunk
+                if len(results) % CLASSIFY_CHUNK_SIZE == 0 or len(results) == len(titles):
+                    percentage = 10 + int((len(results) / len(titles)) * 85)
+                    update_task_progress(task_id, 'running', percentage,
+                                       f'Classified {len(results)}/{len(titles)} unique titles...')
+
+        results = fan_out_results(results, title_groups)
+
+        # Assign in product order so fallbacks don't depend on completion order
+        collections_dict, product_to_collection = assign_classifications(results, suggested_collections, total_products)
+
+        # Remove empty collections
+        all_collections = {name: ids for name, ids in collections_dict.items() if ids}
+
+        # Format for display
+        formatted_collections = {}
+        for collection_name, indices in all_collections.items():
+            formatted_collections[collection_name] = [
+                {"index": idx, "title": product_titles[idx-1]}
+                for idx in sorted(indices) if 1 <= idx <= len(product_titles)
+            ]
+
+        # Store results in session
+        store_data('classified_collections', all_collections, sid=session_id)
+
+        # Complete task
+        update_task_progress(task_id, 'complete', 100, 'Classification complete!', {
+            'collections': formatted_collections,
+            'total_collections': len(all_collections),
+            'total_products': len(product_titles)
+        })
+
+    except Exception as e:
+        update_task_progress(task_id, 'error', 0, str(e))
+
+def run_shopify_update_background(task_id, product_ids, product_titles, collections, shop_url, access_token, session_id):
+    """Run Shopify update with Smart Collections - faster and automatic!"""
+    try:
+        update_task_progress(task_id, 'running', 0, 'Starting Smart Collections update...')
+
+        headers = shopify_headers(access_token)
+
+        # Test permissions for Smart Collections
+        test_url = f"{shopify_admin_url(shop_url)}/smart_collections.json?limit=1"
+        try:
+            test_response = SHOPIFY_SESSION.get(test_url, headers=headers, timeout=30)
+            if test_response.status_code == 403:
+                update_task_progress(task_id, 'error', 0, 'Access token lacks permissions for Smart Collections')
+                return
+            elif test_response.status_code != 200:
+                update_task_progress(task_id, 'error', 0, f'Cannot access Shopify API. Status: {test_response.status_code}')
+                return
+        except Exception as e:
+            update_task_progress(task_id, 'error', 0, f'Connection test failed: {str(e)}')
+            return
+
+        # One pass: each product goes to ONLY ONE collection, and out-of-range
+        # indices are dropped - (index, collection_name) in collection order
+        assignments = []
+        seen_products = set()
+        duplicates_removed = 0
+
+        for collection_name, indices in collections.items():
+            for idx in indices:
+                if not 1 <= idx <= len(product_ids):
+                    continue
+                if idx in seen_products:
+                    duplicates_removed += 1
+                    continue
+                seen_products.add(idx)
+                assignments.append((idx, collection_name))
+
+        if duplicates_removed > 0:
+            update_task_progress(task_id, 'running', 5, f'Removed {duplicates_removed} duplicate products (one product = one collection)')
+
+        collection_names = list(dict.fromkeys(name for _, name in assignments))
+        total_products = len(assignments)
+        total_collections = len(collection_names)
+
+        is_up_to_date = prefetch_up_to_date_check([product_ids[idx - 1] for idx, _ in assignments], shop_url, headers)
+
+        update_task_progress(task_id, 'running', 10, f'Step 1/2: Creating {total_collections} Smart Collections...')
+
+        # STEP 1: Create Smart Collections (fast - no product assignment needed!)
+        # Rule: product_type = collection_name; several collections are created at once
+        processed_collections = 0
+        for collection_name, collection_id in create_smart_collections(collection_names, shop_url, headers):
+            processed_collections += 1
+            progress = 10 + int((processed_collections / total_collections) * 30)
+
+            if collection_id:
+                update_task_progress(task_id, 'running', progress,
+                                   f'Smart Collection {processed_collections}/{total_collections} ready: {collection_name}')
+            else:
+                update_task_progress(task_id, 'running', progress,
+                                   f'⚠️ Failed to create: {collection_name}')
+
+        update_task_progress(task_id, 'running', 40, f'Step 2/2: Updating {total_products} products with metadata...')
+
+        # STEP 2: Update product metadata (product_type + tags)
+        # Smart Collections will auto-populate based on product_type!
+        success_count = 0
+        skipped_count = 0
+        processed_products = 0
+
+        updates = []
+
+        for idx, collection_name in assignments:
+            if is_up_to_date(product_ids[idx - 1], collection_name):
+                processed_products += 1
+                success_count += 1
+                skipped_count += 1
+            else:
+                updates.append((idx - 1, collection_name))
+
+        # Large jobs: one bulk operation instead of a PUT per product
+        if len(updates) >= SHOPIFY_BULK_THRESHOLD:
+            try:
+                for state in bulk_update_product_metadata([(product_ids[i], name) for i, name in updates], shop_url, headers):
+                    if 'results' in state:
+                        processed_products += len(updates)
+                        success_count += sum(1 for ok in state['results'].values() if ok)
+                        updates = []
+                    else:
+                        done = processed_products + state['object_count']
+                        progress = 40 + int((done / total_products) * 55)
+                        update_task_progress(task_id, 'running', progress,
+                                           f'Bulk update {state["status"].lower()}: {done}/{total_products} products')
+            except Exception as e:
+                print(f"Bulk update failed, falling back to per-product updates: {str(e)}")
+
+        # Update product metadata (product_type = collection_name), SHOPIFY_GRAPHQL_BATCH_SIZE
+        # products per request and up to SHOPIFY_MAX_WORKERS requests in flight -
+        # the shop's GraphQL cost limiter paces them
+        updates = [(product_ids[i], collection_name, product_titles[i]) for i, collection_name in updates]
+        with ThreadPoolExecutor(max_workers=SHOPIFY_MAX_WORKERS) as executor:
+            futures = [executor.submit(update_products_batch, updates[start:start + SHOPIFY_GRAPHQL_BATCH_SIZE],
+                                       shop_url, headers)
+                       for start in range(0, len(updates), SHOPIFY_GRAPHQL_BATCH_SIZE)]
+
+            for future in as_completed(futures):
+                results = future.result()
+                processed_products += len(results)
+                success_count += sum(1 for ok in results.values() if ok)
+
+                progress = 40 + int((processed_products / total_products) * 55)
+                update_task_progress(task_id, 'running', progress,
+                                   f'Updating product {processed_products}/{total_products}')
+
+        # Complete
+        update_task_progress(task_id, 'complete', 100, 'Smart Collections created! Products will auto-populate.', {
+            'success_count': success_count,
+            'skipped_count': skipped_count,
+            'total': total_products,
+            'collections': total_collections,
+            'message': 'Smart Collections automatically populate based on product_type. Check your Shopify store!'
+        })
+
+    except Exception as e:
+        update_task_progress(task_id, 'error', 0, str(e))
+
+print(f"✓ Background task manager initialized")
+
+@app.route('/')
+def index():
+    return render_template('index.html')
+
+@app.route('/api/fetch-products', methods=['POST'])
+def fetch_products():
+    try:
+        data = request.json
+        shop_url = data.get('shop_url', '').strip()
+        access_token = data.get('access_token', '').strip()
+        tag = data.get('tag', '').strip()
+        
+        if not shop_url or not access_token or not tag:
+            return jsonify({"success": False, "error": "Missing required fields"}), 400
+        
+        # Clean up shop URL - remove https://, http://, trailing slashes
+        shop_url = shop_url.replace('https://', '').replace('http://', '').rstrip('/')
+        
+        # Store credentials in memory (not in cookie)
+        store_many({'shop_url': shop_url, 'access_token': access_token})
+        
+        headers = shopify_headers(access_token)
+        
+        # One server-side filtered bulk export; fall back to REST pagination if it can't run
+        try:
+            all_products = fetch_tagged_products_bulk(tag, shop_url, headers)
+            print(f"Bulk export complete: {len(all_products)} products matched")
+        except Exception as e:
+            print(f"Bulk export unavailable ({str(e)}), paginating products.json instead")
+            all_products = fetch_tagged_products_rest(tag, shop_url, headers)
+        
+        # Store products in memory (not in cookie) as parallel id/title lists
+        store_many({
+            'product_ids': [p["id"] for p in all_products],
+            'product_titles': [p["title"] for p in all_products],
+        })
+        
+        print(f"✓ Stored {len(all_products)} products in memory store")
+        
+        return jsonify({
+            "success": True,
+            "products": all_products,
+            "count": len(all_products)
+        })
+        
+    except requests.exceptions.Timeout:
+        return jsonify({"success": False, "error": "Request timeout. Please try again."}), 400
+    except requests.exceptions.RequestException as e:
+        return jsonify({"success": False, "error": f"Network error: {str(e)}"}), 400
+    except Exception as e:
+        print(f"Error in fetch_products: {str(e)}")
+        return jsonify({"success": False, "error": str(e)}), 400
+
+@app.route('/api/classify', methods=['POST'])
+def classify_products():
+    try:
+        product_titles = get_data('product_titles', [])
+
+        print(f"DEBUG: Retrieved {len(product_titles)} products from memory store")
+
+        if not product_titles:
+            return jsonify({"success": False, "error": "No products found. Fetch products first."}), 400
+
+        if not OPENAI_API_KEY:
+            return jsonify({"success": False, "error": "OpenAI API key not configured. Add OPENAI_API_KEY to .env file"}), 400
+
+        total_products = len(product_titles)
+        print(f"\n{'='*60}")
+        print(f"STARTING CLASSIFICATION: {total_products} products")
+        print(f"{'='*60}\n")
+
+        # Check if user provided custom collections
+        request_data = request.json or {}
+        user_collections = request_data.get('user_collections', None)
+        use_embeddings = bool(request_data.get('use_embeddings'))
+        use_batch_api = bool(request_data.get('use_batch_api'))
+
+        if user_collections and len(user_collections) > 0:
+            # User provided collections - use them directly
+            print(f"Step 1: Using {len(user_collections)} user-provided collections")
+            print(f"  Collections: {user_collections[:5]}{'...' if len(user_collections) > 5 else ''}\n")
+
+            suggested_collections = user_collections
+
+            # Extract parent mapping if hierarchical format used
+            parent_mapping = get_parent_mapping(suggested_collections)
+
+            store_data('parent_mapping', parent_mapping)
+        else:
+            # No user collections - generate automatically with AI
+            print("Step 1: No custom collections provided - AI will generate them automatically\n")
+
+        # STEP 1: Analyze ALL products and create MANY detailed collections (only if user didn't provide them)
+        if not user_collections:
+            print(f"  Analyzing {total_products} products to generate DETAILED collection hierarchy...")
+            print(f"  Creating 50-150+ specific collections based on product types, sizes, and features...")
+
+            # Reduce sample size to avoid token limits (16K for gpt-3.5-turbo-16k)
+            sample_titles = sample_distinct_titles(product_titles)
+            sample_count = len(sample_titles)
+            all_titles = "\n".join(f"{i}. {title}" for i, title in enumerate(sample_titles, 1))
+            print(f"  Analyzing {sample_count} products...")
+
+            collection_prompt = f"""You are analyzing {sample_count} construction/safety/traffic equipment products (sample from {total_products} total). Create a HIGHLY DETAILED collection structure with MANY specific subcategories.
+
+CRITICAL REQUIREMENTS:
+1. Create 8-15 PARENT categories based on main product types
+2. For EACH parent, create 10-30 SPECIFIC subcategories
+3. Target: 80-200+ total subcategories (the more specific, the better!)
+4. Use SIZE/CAPACITY as primary differentiator (500mm cones vs 750mm cones vs 1m cones)
+5. Use PRODUCT TYPE variations (Traffic Cones, Water Tanks, Safety Signs, Barriers, etc.)
+6. Use MATERIAL/CONSTRUCTION (Metal, Plastic, Aluminum, Steel, etc.)
+7. Use CAPACITY for tanks (100L, 500L, 1000L, 5000L, etc.)
+8. Use SPECIFIC FEATURES (Bunded, Stackable, Heavy Duty, Premium, etc.)
+
+ANALYSIS STRATEGY FOR THIS CATALOG:
+- Traffic Cones → Separate by HEIGHT (460mm, 500mm, 750mm, 1m, etc.)
+- Water Tanks → Separate by CAPACITY (500L, 1000L, 5000L, Underground, Bunded, etc.)
+- Safety Signs → Separate by TYPE (Speed Limit Signs, Warning Signs, Directional, Quick-Fit, Metal, etc.)
+- Barriers → Separate by TYPE (Water-Filled, Pedestrian, Crowd Control, Height Restrictors, etc.)
+- Construction Equipment → Separate by CATEGORY (Buckets, Tubs, Tools, Flooring, etc.)
+- Safety Gear → Separate by TYPE (Coveralls, Gloves, Boots, High-Vis, etc.)
+
+EXAMPLES OF GOOD GRANULARITY:
+Parent: "Traffic Cones"
+  Subcategories: ["460mm Traffic Cones", "500mm Traffic Cones", "750mm Traffic Cones",
+                  "1 Metre Traffic Cones", "Sand Weighted Traffic Cones", "Self-Weighted Traffic Cones",
+                  "Chapter 8 Traffic Cones", "No Waiting Cones", "Cone Accessories"]
+
+Parent: "Water Storage Tanks"
+  Subcategories: ["100-500 Litre Water Tanks", "500-1000 Litre Water Tanks", "1000-2000 Litre Water Tanks",
+                  "2000-5000 Litre Water Tanks", "5000-10000 Litre Water Tanks", "Underground Water Tanks",
+                  "Bunded Water Tanks", "Potable Water Tanks", "Baffled Water Tanks", "Cylindrical Water Tanks"]
+
+Parent: "Traffic Safety Signs"
+  Subcategories: ["Speed Limit Signs (Metal)", "Speed Limit Signs (Quick-Fit)", "Warning Triangle Signs",
+                  "Directional Arrow Signs", "Supplementary Plates", "Custom Signs", "Road Closure Signs",
+                  "Pedestrian Signs", "Roadworks Signs", "Cone Mounted Signs"]
+
+Parent: "Safety Barriers"
+  Subcategories: ["Water-Filled Barriers 1m", "Water-Filled Barriers 2m", "Pedestrian Barriers",
+                  "Crowd Control Barriers", "Height Restriction Barriers", "Temporary Fencing",
+                  "Mesh Barriers", "Chapter 8 Barriers", "Barrier Accessories"]
+
+Parent: "Construction Tools & Equipment"
+  Subcategories: ["Mortar Tubs 100-300L", "Mortar Tubs 300-500L", "Builders Buckets",
+                  "Flooring Tools", "Screeding Equipment", "Trowels & Hand Tools",
+                  "Measuring Tools", "Earth Compaction Tools", "Asphalt Tools"]
+
+Parent: "Safety & PPE"
+  Subcategories: ["High-Visibility Jackets", "High-Visibility Bodywarmers", "Disposable Coveralls",
+                  "Work Trousers", "Safety Boots", "Work Gloves", "Safety Helmets",
+                  "First Aid Kits", "Eye Protection", "Respiratory Protection"]
+
+Parent: "Site Equipment"
+  Subcategories: ["Cable Ramps & Protectors", "Anti-Slip Matting", "Ground Protection Mats",
+                  "Access Mats", "Flooring Sheets", "Scaffold Equipment", "Ladders & Steps",
+                  "Storage Solutions", "Site Furniture", "Waste Management"]
+
+Products to analyze:
+{all_titles}
+
+Return a JSON object with parent categories as keys, and arrays of specific subcategories as values:
+{{
+  "Traffic Cones": ["460mm Traffic Cones", "500mm Traffic Cones", "750mm Traffic Cones", ...],
+  "Water Storage Tanks": ["100-500 Litre Tanks", "500-1000 Litre Tanks", "Underground Tanks", ...],
+  "Traffic Safety Signs": ["Speed Limit Signs Metal", "Warning Signs", "Quick-Fit Signs", ...],
+  ...
+}}
+
+CRITICAL SUCCESS CRITERIA:
+1. Minimum 80 total subcategories (more is better - aim for 100-150+)
+2. Be EXTREMELY SPECIFIC with sizes, capacities, and types
+3. Separate by SIZE/CAPACITY first (e.g., "500mm Cones" vs "750mm Cones")
+4. Then by TYPE/FEATURE (e.g., "Bunded Tanks" vs "Underground Tanks")
+5. Each subcategory must be unique and highly descriptive
+6. Look at product titles and identify all size/capacity variations
+7. Create separate subcategories for different materials (Metal, Plastic, Aluminum)
+8. Products will be assigned to subcategories, so make them VERY SPECIFIC!
+
+REMEMBER: This is construction/safety equipment - use technical specifications!"""
+
+            try:
+                print(f"  Generating collection hierarchy from {sample_count} products...")
+                print(f"  This may take 30-60 seconds...")
+                response = openai_chat(
+                    model="gpt-3.5-turbo-16k",  # Use 16k model for larger responses
+                    messages=[
+                        {"role": "system", "content": "You are an expert construction/safety equipment categorization specialist. Create MANY highly specific subcategories (minimum 80, ideally 100-150+). Separate products by size, capacity, material, and type. Return ONLY valid JSON - no markdown, no explanations."},
+                        {"role": "user", "content": collection_prompt}
+                    ],
+                    temperature=0.3,
+                    max_tokens=4000,  # Large limit for many collections
+                    request_timeout=180  # Increased to 3 minutes for large responses
+                )
+
+                result = response.choices[0].message.content
+
+                print(f"  Parsing AI response (length: {len(result)} chars)...")
+                # Flatten hierarchy into "Parent > Subcategory" names for Shopify
+                suggested_collections, parent_mapping = parse_hierarchy(result)
+
+                print(f"✓ Got {len(set(parent_mapping.values()))} parent categories")
+                print(f"✓ Got {len(suggested_collections)} total subcategories")
+
+                # Validate we have enough collections
+                if len(suggested_collections) < 50:
+                    print(f"  ⚠️ WARNING: Only {len(suggested_collections)} collections created!")
+                    print(f"  ⚠️ Expected 80-150+ for detailed categorization")
+                    print(f"  ⚠️ Products may be grouped too broadly")
+                elif len(suggested_collections) < 80:
+                    print(f"  ⚠️ Got {len(suggested_collections)} collections (recommended: 80+)")
+                else:
+                    print(f"  ✓ Excellent! {len(suggested_collections)} collections will provide detailed organization")
+
+                # Store parent mapping for later use
+                store_data('parent_mapping', parent_mapping)
+
+            except Exception as e:
+                print(f"⚠️ Error getting hierarchical collections: {e}")
+                print(f"⚠️ Using default construction/safety equipment structure")
+                suggested_collections = [
+                    "Traffic Cones > 460mm-500mm Cones", "Traffic Cones > 750mm Cones", "Traffic Cones > 1 Metre Cones",
+                    "Water Tanks > Small Tanks (100-1000L)", "Water Tanks > Medium Tanks (1000-5000L)", "Water Tanks > Large Tanks (5000L+)",
+                    "Water Tanks > Bunded Tanks", "Water Tanks > Underground Tanks",
+                    "Traffic Signs > Speed Limit Signs", "Traffic Signs > Warning Signs", "Traffic Signs > Quick-Fit Signs",
+                    "Traffic Signs > Metal Signs", "Traffic Signs > Supplementary Plates",
+                    "Safety Barriers > Water-Filled Barriers", "Safety Barriers > Pedestrian Barriers", "Safety Barriers > Temporary Fencing",
+                    "Safety Barriers > Height Restrictors", "Safety Barriers > Crowd Control",
+                    "Construction Equipment > Mortar Tubs", "Construction Equipment > Builders Buckets", "Construction Equipment > Hand Tools",
+                    "Safety PPE > High-Vis Clothing", "Safety PPE > Work Gloves", "Safety PPE > Safety Boots",
+                    "Site Equipment > Cable Ramps", "Site Equipment > Anti-Slip Matting", "Site Equipment > Ground Protection"
+                ]
+                parent_mapping = get_parent_mapping(suggested_collections)
+                store_data('parent_mapping', parent_mapping)
+        
+        # STEP 2: Classify products - CLASSIFY_CHUNK_SIZE titles per request, up to OPENAI_MAX_WORKERS in flight
+        print(f"\nStep 2: Classifying {total_products} products ({OPENAI_MAX_WORKERS} at a time)...")
+        print(f"  Available collections: {len(suggested_collections)}")
+        print(f"  This will take a few minutes...\n")
+
+        # Collections list for prompt (formatted nicely)
+        collection_names = list(dict.fromkeys(suggested_collections))
+        if not collection_names:
+            return jsonify({"success": False, "error": NO_COLLECTIONS_ERROR}), 400
+        collections_list = "\n".join(f"- {name}" for name in collection_names)
+
+        # Repeated titles (same product, different SKU) are classified once and fanned back out
+        titles, title_groups = dedupe_titles(enumerate(product_titles, 1))
+        if len(titles) < total_products:
+            print(f"  {total_products - len(titles)} repeated titles will reuse another product's answer")
+
+        # Results arrive in completion order - collect them, then assign in product order
+        # so fallbacks are deterministic
+        results = {}
+        titles_left = titles
+        matched = {}
+        if use_embeddings:
+            matched, titles_left = classify_titles_by_embedding(titles, collection_names)
+            results.update((idx, (collection_name, None)) for idx, collection_name in matched.items())
+            print(f"  Embeddings matched {len(matched)}/{len(titles)} unique titles, {len(titles_left)} left for the chat model")
+
+        # use_batch_api with a large catalog: hand the rest to the OpenAI Batch API (half
+        # price, up to 24h) and return right away - /api/classify-batch-status collects the results
+        if use_batch_api and len(titles_left) > OPENAI_BATCH_THRESHOLD:
+            batch_id = submit_classification_batch(titles_left, collections_list, DETAILED_CLASSIFY_GUIDANCE)
+            store_many({
+                'batch_id': batch_id,
+                'batch_collections': suggested_collections,
+                'batch_title_groups': title_groups,
+                'batch_matched': matched,
+            })
+
+            return jsonify({
+                "success": True,
+                "batch_id": batch_id,
+                "status": "submitted",
+                "message": f"{len(titles_left)} unique titles submitted to the OpenAI Batch API. Check /api/classify-batch-status for results."
+            })
+
+        for idx, collection_name, error in classify_titles_chunked(titles_left, collection_names, DETAILED_CLASSIFY_GUIDANCE):
+            results[idx] = (collection_name, error)
+
+            # Progress indicator every 50 products
+            if len(results) % 50 == 0:
+                print(f"  Progress: {len(results)}/{len(titles)} unique titles classified ({int(len(results)/len(titles)*100)}%)")
+
+        results = fan_out_results(results, title_groups)
+        collections_dict, product_to_collection = assign_classifications(results, suggested_collections, total_products)
+
+        print(f"\n  ✓ Classified all {total_products} products!")
+
+        # STEP 3: Verification
+        print(f"\nStep 3: Verification...")
+
+        # assign_classifications gives every product a collection (falling back to its
+        # running most-populated pointer), so nothing should be missing here
+        if len(product_to_collection) != total_products:
+            return jsonify({"success": False, "error": f"{total_products - len(product_to_collection)} products were left unclassified"}), 500
+        
+        # Remove empty collections
+        all_collections = {name: ids for name, ids in collections_dict.items() if ids}
+        
+        # product_to_collection holds one entry per product, so collections shouldn't overlap
+        total_assigned = sum(map(len, all_collections.values()))
+        if total_assigned != len(product_to_collection):
+            return jsonify({"success": False, "error": "Some products were assigned to more than one collection"}), 500
+        
+        print(f"\n{'='*60}")
+        print(f"CLASSIFICATION COMPLETE")
+        print(f"{'='*60}")
+        print(f"Input: {total_products} products")
+        print(f"Output: {total_assigned} products")
+        print(f"Collections: {len(all_collections)}")
+        
+        if total_assigned == total_products:
+            print(f"✓ SUCCESS: All products classified!")
+        else:
+            print(f"❌ ERROR: Count mismatch!")
+        
+        print(f"{'='*60}\n")
+
+        # Group by parent category for better display
+        parent_breakdown = {}
+        for name, ids in all_collections.items():
+            parent, sep, subcat = name.partition(" > ")
+            if not sep:
+                parent = "Other"
+                subcat = name
+
+            if parent not in parent_breakdown:
+                parent_breakdown[parent] = []
+            parent_breakdown[parent].append((subcat, len(ids)))
+
+        print("COLLECTION BREAKDOWN BY PARENT CATEGORY:\n")
+        for parent in sorted(parent_breakdown.keys()):
+            subcats = parent_breakdown[parent]
+            total_in_parent = sum(count for _, count in subcats)
+            print(f"📁 {parent} ({len(subcats)} subcategories, {total_in_parent} products)")
+            for subcat, count in sorted(subcats, key=lambda x: x[1], reverse=True)[:10]:  # Show top 10
+                print(f"   ├─ {subcat}: {count} products")
+            if len(subcats) > 10:
+                print(f"   └─ ... and {len(subcats) - 10} more subcategories")
+            print()
+        print()
+        
+        # Format for display
+        formatted_collections = {}
+        for collection_name, indices in all_collections.items():
+            formatted_collections[collection_name] = [
+                {"index": idx, "title": product_titles[idx-1]}
+                for idx in sorted(indices) if 1 <= idx <= len(product_titles)
+            ]
+        
+        # Log what we're storing
+        print(f"[STORING] {len(all_collections)} collections with {total_assigned} total products")
+        
+        store_data('classified_collections', all_collections)
+        
+        return jsonify({
+            "success": True,
+            "collections": formatted_collections,
+            "total_collections": len(all_collections),
+            "total_products": total_assigned
+        })
+        
+    except Exception as e:
+        print(f"Classification error: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({"success": False, "error": str(e)}), 400
+
+@app.route('/api/classify-batch-status', methods=['GET'])
+def classify_batch_status():
+    """Check a Batch API classification and collect its results once complete"""
+    try:
+        batch_id = request.args.get('batch_id') or get_data('batch_id')
+
+        if not batch_id:
+            return jsonify({"success": False, "error": "No batch ID provided"}), 400
+
+        batch = openai_request("get", f"/batches/{batch_id}").json()
+        status = batch["status"]
+        counts = batch.get("request_counts") or {}
+
+        if status in ("failed", "expired", "cancelled"):
+            return jsonify({"success": False, "status": status, "error": f"Batch {status}"}), 400
+
+        if status != "completed":
+            return jsonify({
+                "success": True,
+                "batch_id": batch_id,
+                "status": status,
+                "completed": counts.get("completed", 0),
+                "total": counts.get("total", 0)
+            })
+
+        product_titles, suggested_collections, title_groups, matched = get_many({
+            'product_titles': [],
+            'batch_collections': [],
+            'batch_title_groups': None,
+            'batch_matched': {},
+        })
+
+        # Titles the embeddings matched before the batch was submitted weren't part of it
+        results = {int(idx): (collection_name, None) for idx, collection_name in matched.items()}
+        results.update(read_classification_batch(batch))
+        if title_groups:
+            results = fan_out_results(results, title_groups)
+        collections_dict, product_to_collection = assign_classifications(results, suggested_collections, len(product_titles))
+
+        # Remove empty collections
+        all_collections = {name: ids for name, ids in collections_dict.items() if ids}
+        store_data('classified_collections', all_collections)
+
+        # Format for display
+        formatted_collections = {}
+        for collection_name, indices in all_collections.items():
+            formatted_collections[collection_name] = [
+                {"index": idx, "title": product_titles[idx-1]}
+                for idx in sorted(indices) if 1 <= idx <= len(product_titles)
+            ]
+
+        print(f"[BATCH] {batch_id} complete: {len(results)} results, {len(all_collections)} collections")
+
+        return jsonify({
+            "success": True,
+            "batch_id": batch_id,
+            "status": status,
+            "collections": formatted_collections,
+            "total_collections": len(all_collections),
+            "total_products": len(product_to_collection)
+        })
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+@app.route('/api/classify-start', methods=['POST'])
+def classify_start():
+    """Start classification in background thread"""
+    try:
+        data = request.json or {}
+        user_collections = data.get('user_collections', None)
+        use_batch_api = bool(data.get('use_batch_api'))
+        use_embeddings = bool(data.get('use_embeddings'))
+
+        # Get products from session
+        product_titles = get_data('product_titles', [])
+
+        if not product_titles:
+            return jsonify({"success": False, "error": "No products found. Fetch products first."}), 400
+
+        # Parse user collections
+        if user_collections and len(user_collections) > 0:
+            user_collections_list = user_collections
+        else:
+            user_collections_list = None
+
+        # Create task
+        task_id = get_task_id()
+        session_id = get_session_id()
+
+        # Store task ID in session
+        store_data('current_task_id', task_id)
+
+        # Queue the job on the background pool; it reports 'running' from the start
+        # so progress streams opened right away find the task
+        update_task_progress(task_id, 'running', 0, 'Waiting for a free worker...')
+        background_jobs.submit(run_classification_background, task_id, product_titles, user_collections_list, session_id, use_batch_api, use_embeddings)
+
+        return jsonify({
+            "success": True,
+            "task_id": task_id,
+            "message": "Classification started in background"
+        })
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+@app.route('/api/classification-status', methods=['GET'])
+def classification_status():
+    """Get classification task status"""
+    try:
+        # Get task_id from query params or from session
+        task_id = request.args.get('task_id') or get_data('current_task_id')
+
+        if not task_id:
+            return jsonify({"success": False, "error": "No task ID provided"}), 400
+
+        task = get_task_status(task_id)
+
+        if not task:
+            return jsonify({"success": False, "error": "Task not found"}), 404
+
+        return jsonify({
+            "success": True,
+            "task_id": task_id,
+            "status": task['status'],
+            "progress": task['progress'],
+            "message": task['message'],
+            "data": task.get('data'),
+            "updated_at": task['updated_at'].isoformat()
+        })
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+@app.route('/api/classify-stream', methods=['GET'])
+def classify_products_stream():
+    def generate():
+        try:
+            print("[STREAM] Starting classification stream...")
+            product_titles, user_collections = get_many({'product_titles': [], 'user_collections_input': None})
+            print(f"[STREAM] Products: {len(product_titles)}, User collections: {len(user_collections) if user_collections else 0}")
+
+            if not product_titles:
+                print("[STREAM] ERROR: No products found")
+                yield sse_event({'type': 'error', 'message': 'No products found. Fetch products first.'})
+                return
+
+            if not OPENAI_API_KEY:
+                print("[STREAM] ERROR: OpenAI API key not configured")
+                yield sse_event({'type': 'error', 'message': 'OpenAI API key not configured. Please add OPENAI_API_KEY to .env file'})
+                return
+
+            total_products = len(product_titles)
+
+            yield sse_event({'type': 'start', 'total': total_products})
+
+            # Step 1: Get or generate collections
+            if user_collections and len(user_collections) > 0:
+                suggested_collections = user_collections
+                yield sse_event({'type': 'info', 'message': f'Using {len(user_collections)} custom collections'})
+
+                parent_mapping = get_parent_mapping(suggested_collections)
+                store_data('parent_mapping', parent_mapping)
+            else:
+                # AI generation (same as before, but with progress updates)
+                yield sse_event({'type': 'info', 'message': 'Generating collections with AI...'})
+
+                # Reduce sample size to avoid token limits (16K for gpt-3.5-turbo-16k)
+                sample_titles = sample_distinct_titles(product_titles)
+                sample_count = len(sample_titles)
+                all_titles = "\n".join(f"{i}. {title}" for i, title in enumerate(sample_titles, 1))
+
+                collection_prompt = f"""You are analyzing {sample_count} construction/safety/traffic equipment products (sample from {total_products} total). Create a HIGHLY DETAILED collection structure with MANY specific subcategories.
+
+CRITICAL REQUIREMENTS:
+1. Create 8-15 PARENT categories based on main product types
+2. For EACH parent, create 10-30 SPECIFIC subcategories
+3. Target: 80-200+ total subcategories (the more specific, the better!)
+
+Products to analyze:
+{all_titles}
+
+Return a JSON object with parent categories as keys, and arrays of specific subcategories as values."""
+
+                try:
+                    response = openai_chat(
+                        model="gpt-3.5-turbo-16k",
+                        messages=[
+                            {"role": "system", "content": "You are an expert categorization specialist. Return ONLY valid JSON."},
+                            {"role": "user", "content": collection_prompt}
+                        ],
+                        temperature=0.3,
+                        max_tokens=4000,
+                        request_timeout=180
+                    )
+
+                    suggested_collections, parent_mapping = parse_hierarchy(response.choices[0].message.content)
+
+                    store_data('parent_mapping', parent_mapping)
+                    yield sse_event({'type': 'info', 'message': f'Generated {len(suggested_collections)} collections'})
+
+                except Exception as e:
+                    yield sse_event({'type': 'error', 'message': f'AI generation failed: {str(e)}'})
+                    return
+
+            # Step 2: Classify products in batches with progress updates
+            BATCH_SIZE = 500
+            total_batches = (total_products + BATCH_SIZE - 1) // BATCH_SIZE  # Ceiling division
+
+            collection_names = list(dict.fromkeys(suggested_collections))
+            if not collection_names:
+                yield sse_event({'type': 'error', 'message': NO_COLLECTIONS_ERROR})
+                return
+            results = {}
+
+            # Each distinct title is sent once, in the batch where it first appears
+            unique_titles, title_groups = dedupe_titles(enumerate(product_titles, 1))
+
+            # ?use_embeddings=1: confident nearest-collection matches skip the chat model
+            if request.args.get('use_embeddings') == '1':
+                matched, _ = classify_titles_by_embedding(unique_titles, collection_names)
+                results.update((idx, (collection_name, None)) for idx, collection_name in matched.items())
+                yield sse_event({'type': 'info', 'message': f'Embeddings matched {len(matched)}/{len(unique_titles)} unique titles'})
+
+            yield sse_event({'type': 'info', 'message': f'Processing {total_products} products ({len(unique_titles)} unique titles) in {total_batches} batches of {BATCH_SIZE}'})
+
+            # Progress events differ only in their numbers and the title - render the rest once,
+            # compact like sse_event's orjson output
+            progress_prefix = f'data: {{"type":"progress","total":{total_products},'.encode()
+
+            for batch_num in range(total_batches):
+                batch_start = batch_num * BATCH_SIZE + 1
+                batch_end = min((batch_num + 1) * BATCH_SIZE, total_products)
+                batch_size = batch_end - batch_start + 1
+
+                yield sse_event({'type': 'batch_start', 'batch': batch_num + 1, 'total_batches': total_batches, 'start': batch_start, 'end': batch_end})
+
+                # CLASSIFY_CHUNK_SIZE titles per request, up to OPENAI_MAX_WORKERS requests in flight
+                batch_titles = [(idx, product_titles[idx - 1]) for idx in range(batch_start, batch_end + 1)
+                                if idx in title_groups and idx not in results]
+                for done, (idx, collection_name, error) in enumerate(classify_titles_chunked(batch_titles, collection_names), 1):
+                    results[idx] = (collection_name, error)
+
+                    # Send progress update every 10 products
+                    if done % 10 == 0 or done == 1:
+                        current = batch_start - 1 + int(done / len(batch_titles) * batch_size)
+                        percentage = int((current / total_products) * 100)
+                        batch_progress = int((done / len(batch_titles)) * 100)
+                        yield (progress_prefix + f'"current":{current},"percentage":{percentage},"batch":{batch_num + 1},"batch_progress":{batch_progress},"product":'.encode()
+                               + orjson.dumps(product_titles[idx - 1]) + b'}\n\n')
+
+                # Batch complete
+                yield sse_event({'type': 'batch_complete', 'batch': batch_num + 1, 'total_batches': total_batches, 'products_classified': batch_end})
+
+            # Unknown answers and failures fall back to the most populated collection
+            results = fan_out_results(results, title_groups)
+            collections_dict, _ = assign_classifications(results, suggested_collections, total_products)
+
+            # Remove empty collections
+            all_collections = {name: ids for name, ids in collections_dict.items() if ids}
+
+            # Format for display
+            formatted_collections = {}
+            for collection_name, indices in all_collections.items():
+                formatted_collections[collection_name] = [
+                    {"index": idx, "title": product_titles[idx-1]}
+                    for idx in sorted(indices) if 1 <= idx <= len(product_titles)
+                ]
+
+            # Store results
+            store_data('classified_collections', all_collections)
+
+            # Send completion
+            yield sse_event({'type': 'complete', 'collections': formatted_collections, 'total_collections': len(all_collections), 'total_products': len(product_titles)})
+
+        except Exception as e:
+            yield sse_event({'type': 'error', 'message': str(e)})
+
+    return sse_response(generate())
+
+@app.route('/api/update-shopify-start', methods=['POST'])
+def update_shopify_start():
+    """Start Shopify update in background thread"""
+    try:
+        # Get data from session
+        product_ids, product_titles, collections, shop_url, access_token = get_many({
+            'product_ids': [],
+            'product_titles': [],
+            'classified_collections': {},
+            'shop_url': '',
+            'access_token': '',
+        })
+
+        if not product_ids or not collections:
+            return jsonify({"success": False, "error": "No classification data found"}), 400
+
+        if not shop_url or not access_token:
+            return jsonify({"success": False, "error": "Missing Shopify credentials"}), 400
+
+        # Create task
+        task_id = get_task_id()
+        session_id = get_session_id()
+
+        # Store task ID in session
+        store_data('current_update_task_id', task_id)
+
+        # Queue the job on the background pool; it reports 'running' from the start
+        # so progress streams opened right away find the task
+        update_task_progress(task_id, 'running', 0, 'Waiting for a free worker...')
+        background_jobs.submit(run_shopify_update_background, task_id, product_ids, product_titles, collections, shop_url, access_token, session_id)
+
+        return jsonify({
+            "success": True,
+            "task_id": task_id,
+            "message": "Shopify update started in background"
+        })
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+@app.route('/api/update-shopify-status', methods=['GET'])
+def update_shopify_status():
+    """Get Shopify update task status"""
+    try:
+        # Get task_id from query params or from session
+        task_id = request.args.get('task_id') or get_data('current_update_task_id')
+
+        if not task_id:
+            return jsonify({"success": False, "error": "No task ID provided"}), 400
+
+        task = get_task_status(task_id)
+
+        if not task:
+            return jsonify({"success": False, "error": "Task not found"}), 404
+
+        return jsonify({
+            "success": True,
+            "task_id": task_id,
+            "status": task['status'],
+            "progress": task['progress'],
+            "message": task['message'],
+            "data": task.get('data'),
+            "updated_at": task['updated_at'].isoformat()
+        })
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+@app.route('/api/task/<task_id>/stream', methods=['GET'])
+def task_progress_stream(task_id):
+    """Push a background task's status as Server-Sent Events until it finishes.
+
+    Each event carries the same JSON as the polled status endpoints; a comment
+    line is sent every 15 seconds without updates to keep the connection open."""
+    def generate():
+        seen = None
+        last_sent = time.monotonic()
+        while True:
+            with tasks_changed:
+                if task_id in classification_tasks:
+                    tasks_changed.wait_for(lambda: classification_tasks[task_id]['version'] != seen, timeout=SSE_KEEPALIVE_INTERVAL)
+                    task = dict(classification_tasks[task_id])
+                else:
+                    task = None
+
+            if task is None:
+                # Running on another worker - follow its Redis copy
+                task = get_task_status(task_id)
+                if task and task['version'] == seen:
+                    time.sleep(TASK_FLUSH_INTERVAL)
+
+            if not task:
+                yield sse_event({'success': False, 'error': 'Task not found'})
+                return
+
+            if task['version'] == seen:
+                # Redis copies are polled every TASK_FLUSH_INTERVAL - only talk when the line's been quiet
+                if time.monotonic() - last_sent >= SSE_KEEPALIVE_INTERVAL:
+                    last_sent = time.monotonic()
+                    yield SSE_KEEPALIVE
+                continue
+            seen = task['version']
+
+            last_sent = time.monotonic()
+            yield sse_event({'success': True, 'task_id': task_id, 'status': task['status'], 'progress': task['progress'], 'message': task['message'], 'data': task.get('data'), 'updated_at': task['updated_at'].isoformat()})
+
+            if task['status'] in ('complete', 'error'):
+                return
+
+    return sse_response(generate())
+
+@app.route('/api/update-shopify-stream', methods=['GET'])
+def update_shopify_stream():
+    def generate():
+        try:
+            product_ids, product_titles, collections, shop_url, access_token = get_many({
+                'product_ids': [],
+                'product_titles': [],
+                'classified_collections': {},
+                'shop_url': '',
+                'access_token': '',
+            })
+
+            # Verify token permissions first
+            headers = shopify_headers(access_token)
+
+            # Test Smart Collections endpoint
+            test_url = f"{shopify_admin_url(shop_url)}/smart_collections.json?limit=1"
+            try:
+                test_response = SHOPIFY_SESSION.get(test_url, headers=headers, timeout=30)
+                if test_response.status_code == 403:
+                    yield sse_event({'type': 'error', 'message': 'Access token lacks permissions for Smart Collections. Please verify read_products and write_products scopes.'})
+                    return
+                elif test_response.status_code != 200:
+                    yield sse_event({'type': 'error', 'message': f'Cannot access Shopify API. Status: {test_response.status_code}'})
+                    return
+            except Exception as e:
+                yield sse_event({'type': 'error', 'message': f'Connection test failed: {str(e)}'})
+                return
+
+            # Log what we retrieved
+            retrieved_total = sum(len(ids) for ids in collections.values())
+            logger.info(f"\n[SMART COLLECTIONS UPDATE] Retrieved {len(collections)} collections with {retrieved_total} products")
+
+            if not collections:
+                yield sse_event({'type': 'error', 'message': 'No classification data'})
+                return
+
+            if not shop_url or not access_token:
+                yield sse_event({'type': 'error', 'message': 'Missing credentials'})
+                return
+
+            # One pass: each product in ONLY ONE collection, out-of-range indices dropped
+            seen_products = set()
+            clean_collections = {}
+            duplicates_removed = 0
+
+            for collection_name, indices in collections.items():
+                unique_indices = []
+                for idx in indices:
+                    if not 1 <= idx <= len(product_ids):
+                        continue
+                    if idx in seen_products:
+                        duplicates_removed += 1
+                        continue
+                    seen_products.add(idx)
+                    unique_indices.append(idx)
+
+                if unique_indices:
+                    clean_collections[collection_name] = unique_indices
+
+            collections = clean_collections
+
+            if duplicates_removed > 0:
+                yield sse_event({'type': 'info', 'message': f'Removed {duplicates_removed} duplicates (one product = one collection)'})
+
+            total_products = len(seen_products)
+            total_collections = len(collections)
+
+            is_up_to_date = prefetch_up_to_date_check([product_ids[idx - 1] for idx in seen_products], shop_url, headers)
+
+            yield sse_event({'type': 'start', 'total': total_products, 'collections': total_collections})
+            yield sse_event({'type': 'info', 'message': f'Step 1/2: Creating {total_collections} Smart Collections...'})
+
+            # STEP 1: Create Smart Collections (fast!)
+            # Several collections are created at once - events arrive as each one is ready
+            collections_created = 0
+            for created in create_smart_collections(collections.keys(), shop_url, headers, keepalive=True):
+                if created is None:
+                    yield SSE_KEEPALIVE
+                    continue
+                collection_name, collection_id = created
+                collections_created += 1
+
+                if collection_id:
+                    yield sse_event({'type': 'collection_created', 'name': collection_name, 'id': collection_id, 'progress': f'{collections_created}/{total_collections}'})
+                else:
+                    yield sse_event({'type': 'collection_error', 'name': collection_name, 'message': 'Failed to create'})
+
+            yield sse_event({'type': 'info', 'message': f'Step 2/2: Updating {total_products} products...'})
+
+            # STEP 2: Update product metadata - one bulk operation for large jobs, otherwise
+            # SHOPIFY_GRAPHQL_BATCH_SIZE products per request, up to SHOPIFY_MAX_WORKERS in flight
+            success_count = 0
+            skipped_count = 0
+            processed_count = 0
+            updates = []
+            pending = {}
+            executor = ThreadPoolExecutor(max_workers=SHOPIFY_MAX_WORKERS)
+
+            try:
+                for collection_name, indices in collections.items():
+                    # Pre-render the event prefixes once per collection - only the title changes per
+                    # product. Compact separators, so frames match sse_event's orjson output
+                    collection_json = orjson.dumps(collection_name)
+                    updated_prefix = b'data: {"type":"product_updated","collection":' + collection_json + b',"product":'
+                    skipped_prefix = b'data: {"type":"product_skipped","collection":' + collection_json + b',"product":'
+                    error_prefix = b'data: {"type":"product_error","collection":' + collection_json + b',"product":'
+
+                    # Events for several products go out as one write, not one flush per product
+                    frames = []
+                    for idx in indices:
+                        product_title = product_titles[idx - 1]
+
+                        if is_up_to_date(product_ids[idx - 1], collection_name):
+                            processed_count += 1
+                            success_count += 1
+                            skipped_count += 1
+                            frames.append(skipped_prefix + orjson.dumps(product_title) + f',"progress":"{processed_count}/{total_products}"}}\n\n'.encode())
+                            continue
+
+                        updates.append((product_ids[idx - 1], product_title, collection_name, updated_prefix, error_prefix))
+                    if frames:
+                        yield b"".join(frames)
+
+                if len(updates) >= SHOPIFY_BULK_THRESHOLD:
+                    try:
+                        yield sse_event({'type': 'info', 'message': f'Submitting {len(updates)} product updates as one bulk operation...'})
+                        for state in bulk_update_product_metadata([(u[0], u[2]) for u in updates], shop_url, headers):
+                            if 'results' not in state:
+                                yield sse_event({'type': 'bulk_progress', 'status': state['status'], 'processed': state['object_count'], 'total': len(updates)})
+                                continue
+
+                            frames = []
+                            for product_id, product_title, collection_name, updated_prefix, error_prefix in updates:
+                                processed_count += 1
+                                if state['results'].get(product_id):
+                                    success_count += 1
+                                    frames.append(updated_prefix + orjson.dumps(product_title) + f',"progress":"{processed_count}/{total_products}"}}\n\n'.encode())
+                                else:
+                                    frames.append(error_prefix + orjson.dumps(product_title) + b'}\n\n')
+                            yield b"".join(frames)
+                            updates = []
+                    except Exception as e:
+                        logger.warning(f"Bulk update failed, falling back to per-product updates: {str(e)}")
+                        yield sse_event({'type': 'info', 'message': 'Bulk update unavailable - updating products one by one'})
+
+                for start in range(0, len(updates), SHOPIFY_GRAPHQL_BATCH_SIZE):
+                    batch = updates[start:start + SHOPIFY_GRAPHQL_BATCH_SIZE]
+                    future = executor.submit(update_products_batch, [(u[0], u[2], u[1]) for u in batch],
+                                             shop_url, headers)
+                    pending[future] = batch
+
+                # Stream updates as each batch finishes - one write per batch
+                for future in as_completed_with_keepalive(pending):
+                    if future is None:
+                        yield SSE_KEEPALIVE
+                        continue
+                    results = future.result()
+
+                    frames = []
+                    for product_id, product_title, collection_name, updated_prefix, error_prefix in pending[future]:
+                        processed_count += 1
+                        if results.get(product_id):
+                            success_count += 1
+                            frames.append(updated_prefix + orjson.dumps(product_title) + f',"progress":"{processed_count}/{total_products}"}}\n\n'.encode())
+                        else:
+                            frames.append(error_prefix + orjson.dumps(product_title) + b'}\n\n')
+                    yield b"".join(frames)
+            finally:
+                # Don't keep updating Shopify if the client disconnected mid-stream
+                executor.shutdown(wait=False, cancel_futures=True)
+
+            yield sse_event({'type': 'complete', 'success_count': success_count, 'skipped_count': skipped_count, 'total': total_products, 'collections': total_collections, 'message': 'Smart Collections will auto-populate! Check your Shopify store.'})
+
+        except PermissionError as e:
+            yield sse_event({'type': 'error', 'message': str(e), 'is_permission_error': True})
+        except Exception as e:
+            yield sse_event({'type': 'error', 'message': str(e)})
+
+    return sse_response(generate())
+
+# Shopify rate limits are per store, so every job for the same shop shares one bucket
+rate_limiters = {}
+graphql_limiters = {}
+rate_limiters_lock = Lock()
+
+@lru_cache(maxsize=512)
+def shopify_admin_url(shop_url):
+    """Admin API base URL for a shop, built once per shop instead of per request"""
+    return f"https://{shop_url}/admin/api/{SHOPIFY_API_VERSION}"
+
+def shopify_headers(access_token):
+    """Admin API request headers, built once per job and reused for every call"""
+    return {
+        "X-Shopify-Access-Token": access_token,
+        "Content-Type": "application/json"
+    }
+
+def get_rate_limiter(shop_url):
+    """Get the shared request limiter for a shop"""
+    with rate_limiters_lock:
+        if shop_url not in rate_limiters:
+            # Shopify's bucket is per store, not per process - with Redis, all workers share it
+            rate_limiters[shop_url] = make_rate_limiter(shop_url, SHOPIFY_BUCKET_SIZE, SHOPIFY_REQUESTS_PER_SECOND)
+        return rate_limiters[shop_url]
+
+def sync_shopify_call_limit(response, *args, **kwargs):
+    """Session response hook: pull the shop's REST bucket down to X-Shopify-Shop-Api-Call-Limit
+
+    The header ("used/limit") counts every app's calls on the store, so pacing stays
+    right when other apps or workers are using the same bucket."""
+    call_limit = response.headers.get('X-Shopify-Shop-Api-Call-Limit')
+    if not call_limit:
+        return
+    limiter = rate_limiters.get(urlsplit(response.url).netloc)
+    used, _, limit = call_limit.partition('/')
+    if limiter and used.isdigit() and limit.isdigit():
+        limiter.observe(int(limit) - int(used))
+
+SHOPIFY_SESSION.hooks["response"].append(sync_shopify_call_limit)
+
+def shopify_get(shop_url, url, max_retries=5, **kwargs):
+    """GET through the shop's rate limiter; a 429 cools the limiter down for Retry-After and retries"""
+    limiter = get_rate_limiter(shop_url)
+    for attempt in range(max_retries):
+        limiter.acquire()
+        response = SHOPIFY_SESSION.get(url, **kwargs)
+        if response.status_code != 429 or attempt == max_retries - 1:
+            return response
+        retry_after = float(response.headers.get('Retry-After', 2))
+        logger.warning(f"Rate limit hit, waiting {retry_after} seconds...")
+        response.close()
+        limiter.cooldown(retry_after)  # the next acquire() waits it out
+
+def get_graphql_limiter(shop_url):
+    """Get the shared GraphQL query-cost limiter for a shop"""
+    with rate_limiters_lock:
+        if shop_url not in graphql_limiters:
+            graphql_limiters[shop_url] = make_rate_limiter(f"graphql:{shop_url}", SHOPIFY_GRAPHQL_BUCKET_SIZE,
+                                                           SHOPIFY_GRAPHQL_RESTORE_RATE)
+        return graphql_limiters[shop_url]
+
+def get_next_page_url(response):
+    """Extract the rel="next" URL from Shopify's Link header (None on the last page)"""
+    link_header = response.headers.get("Link", "")
+    for link in link_header.split(","):
+        if "rel=\"next\"" in link:
+            return link.split(";")[0].strip("<> ")
+    return None
+
+# shop_url -> {lowercased title: smart collection id}, filled by one paginated scan per
+# shop; the least recently scanned shops are dropped past SMART_COLLECTION_CACHE_SHOPS
+SMART_COLLECTION_CACHE_SHOPS = 512
+smart_collection_cache = {}
+smart_collection_lock = Lock()
+
+# shop_url -> {page URL: (ETag, smart collections, next page URL)} from the shop's last scan;
+# unchanged pages come back as 304. Evicted together with the shop's smart_collection_cache entry
+smart_collection_pages = {}
+
+def load_smart_collections(shop_url, headers):
+    """Page through every smart collection in the shop once and cache title -> id (also returned)"""
+    url = f"{shopify_admin_url(shop_url)}/smart_collections.json?limit=250&fields=id,title"
+    found = {}
+    pages = {}
+
+    # Replaced wholesale after each scan, never mutated, so it's safe to read outside the lock
+    with smart_collection_lock:
+        cached_pages = smart_collection_pages.get(shop_url, {})
+
+    while url:
+        cached = cached_pages.get(url)
+        page_headers = {**headers, "If-None-Match": cached[0]} if cached else headers
+
+        response = shopify_get(shop_url, url, headers=page_headers, timeout=30)
+
+        if response.status_code == 304:
+            collections, next_url = cached[1], cached[2]
+            pages[url] = cached
+        else:
+            response.raise_for_status()
+            collections = orjson.loads(response.content)["smart_collections"]
+            next_url = get_next_page_url(response)
+            if response.headers.get("ETag"):
+                pages[url] = (response.headers["ETag"], collections, next_url)
+
+        for col in collections:
+            found[col["title"].lower()] = col["id"]
+        url = next_url
+
+    # Only this scan's pages are kept, so stale page_info cursors don't pile up
+    with smart_collection_lock:
+        smart_collection_cache.pop(shop_url, None)
+        smart_collection_pages.pop(shop_url, None)
+        if len(smart_collection_cache) >= SMART_COLLECTION_CACHE_SHOPS:
+            oldest = next(iter(smart_collection_cache))
+            del smart_collection_cache[oldest]
+            smart_collection_pages.pop(oldest, None)
+        smart_collection_cache[shop_url] = found
+        smart_collection_pages[shop_url] = pages
+    logger.info(f"✓ Loaded {len(found)} existing Smart Collections")
+    return found
+
+# Shopify returns the new resource URL in the Location header on create,
+# e.g. /admin/api/2024-10/smart_collections/12345.json
+LOCATION_ID_RE = re.compile(r'/(\d+)\.json')
+
+def get_created_id(response):
+    """Extract the created resource ID from the Location header (None if absent)"""
+    match = LOCATION_ID_RE.search(response.headers.get('Location', ''))
+    return int(match.group(1)) if match else None
+
+def create_or_get_smart_collection(collection_name, shop_url, headers):
+    """Create or get SMART collection with rules based on product_type"""
+    max_retries = 3
+    collection_key = collection_name.lower()
+
+    # Create new SMART collection with rule: product_type equals collection_name.
+    # The request never changes between attempts, so it is built once
+    create_url = f"{shopify_admin_url(shop_url)}/smart_collections.json"
+    payload = {
+        "smart_collection": {
+            "title": collection_name,
+            "published": True,
+            "rules": [
+                {
+                    "column": "type",  # product_type field
+                    "relation": "equals",
+                    "condition": collection_name  # Exact match
+                }
+            ],
+            "disjunctive": False  # Must match all rules (only one rule, so strict match)
+        }
+    }
+
+    for attempt in range(max_retries):
+        try:
+            # One paginated scan per shop, then a dict lookup per collection
+            shop_collections = smart_collection_cache.get(shop_url)
+            if shop_collections is None:
+                shop_collections = load_smart_collections(shop_url, headers)
+
+            collection_id = shop_collections.get(collection_key)
+            if collection_id:
+                logger.info(f"✓ Found existing Smart Collection: {collection_name} (ID: {collection_id})")
+                return collection_id
+
+            # Debug logging
+            logger.info(f"\n[CREATE SMART COLLECTION]")
+            logger.info(f"  Collection: {collection_name}")
+            logger.info(f"  Rule: product_type EQUALS '{collection_name}'")
+
+            get_rate_limiter(shop_url).acquire()
+            response = SHOPIFY_SESSION.post(create_url, headers=headers, json=payload, timeout=30)
+
+            if response.status_code == 429:
+                retry_after = float(response.headers.get('Retry-After', 2))
+                logger.warning(f"Rate limit hit, waiting {retry_after} seconds...")
+                get_rate_limiter(shop_url).cooldown(retry_after)  # the next acquire() waits it out
+                continue
+
+            response.raise_for_status()
+
+            # Prefer the Location header - only parse the full body if it's missing
+            collection_id = get_created_id(response)
+            if not collection_id:
+                response_data = orjson.loads(response.content)
+                if "smart_collection" not in response_data:
+                    logger.warning(f"Unexpected response creating Smart Collection {collection_name}")
+                    logger.warning(f"Status: {response.status_code}, Response: {response.text[:500]}")
+
+                    # Check if it's a permissions issue
+                    if "errors" in response_data:
+                        error_msg = (
+                            f"PERMISSION ERROR: Cannot create Smart Collection '{collection_name}'. "
+                            f"Your Shopify API token is missing the 'write_collections' scope. "
+                            f"Please verify your app has read_products and write_products scopes."
+                        )
+                        logger.warning(f"ERROR: {error_msg}")
+                        raise PermissionError(error_msg)
+                    if attempt < max_retries - 1:
+                        time.sleep(2 * (attempt + 1))
+                        continue
+                    return None
+
+                collection_id = response_data["smart_collection"]["id"]
+            shop_collections[collection_key] = collection_id
+            logger.info(f"✓ Created Smart Collection: {collection_name} (ID: {collection_id})")
+            logger.info(f"  → Auto-populates products with product_type = '{collection_name}'")
+            return collection_id
+
+        except requests.exceptions.Timeout:
+            logger.warning(f"Timeout creating Smart Collection {collection_name}, attempt {attempt + 1}/{max_retries}")
+            if attempt < max_retries - 1:
+                time.sleep(2 * (attempt + 1))
+                continue
+
+        except Exception as e:
+            logger.warning(f"Error creating/getting Smart Collection {collection_name}: {str(e)}")
+            if attempt < max_retries - 1:
+                time.sleep(2 * (attempt + 1))
+                continue
+
+    return None
+
+def create_smart_collections(collection_names, shop_url, headers, keepalive=False):
+    """Create or find every smart collection, up to SHOPIFY_MAX_WORKERS at once.
+
+    Re-scans the shop's existing collections first (once per job, in case they
+    changed in Shopify) so the workers only do dict lookups and creates.
+    Yields (collection_name, collection_id or None) in completion order - with
+    keepalive, also None after each SSE_KEEPALIVE_INTERVAL without a result."""
+    try:
+        load_smart_collections(shop_url, headers)
+    except Exception as e:
+        logger.warning(f"Could not list existing Smart Collections: {str(e)}")
+        with smart_collection_lock:
+            smart_collection_cache.pop(shop_url, None)  # create_or_get_smart_collection retries the scan
+
+    with ThreadPoolExecutor(max_workers=SHOPIFY_MAX_WORKERS) as executor:
+        futures = {executor.submit(create_or_get_smart_collection, name, shop_url, headers): name
+                   for name in collection_names}
+        for future in (as_completed_with_keepalive(futures) if keepalive else as_completed(futures)):
+            yield None if future is None else (futures[future], future.result())
+
+def update_product_metadata(product_id, collection_name, product_title, shop_url, headers):
+    """Update product with ONLY the collection name as tag (replaces all existing tags).
+    Also sets product_type to the exact collection name.
+    Smart Collections will auto-populate based on product_type match.
+
+    IMPORTANT: This replaces ALL existing tags with ONLY the collection name."""
+    max_retries = 3
+    retry_delay = 1  # seconds
+
+    # The PUT replaces tags and product_type outright, so the current product
+    # isn't fetched first - one request per product, built once for every attempt
+    product_url = f"{shopify_admin_url(shop_url)}/products/{product_id}.json"
+
+    # CRITICAL: Set ONLY the collection name as the tag (replace all existing tags)
+    # Each product gets ONLY ONE tag = the exact collection name
+    updated_tags = collection_name
+
+    # CRITICAL: Set product_type to EXACT collection name
+    # This is what Smart Collections will match against!
+    product_type_value = collection_name
+
+    # Update product with exact collection name as both tag and type - serialized once with
+    # orjson rather than by requests' stdlib json on every attempt
+    update_body = orjson.dumps({
+        "product": {
+            "id": product_id,
+            "tags": updated_tags,
+            "product_type": product_type_value  # EXACT match for Smart Collection rule
+        }
+    })
+
+    for attempt in range(max_retries):
+        try:
+            get_rate_limiter(shop_url).acquire()
+            update_response = SHOPIFY_SESSION.put(product_url, headers=headers, data=update_body, timeout=30)
+
+            if update_response.status_code == 429:
+                retry_after = float(update_response.headers.get('Retry-After', 2))
+                logger.warning(f"Rate limit hit while updating product, waiting {retry_after} seconds...")
+                get_rate_limiter(shop_url).cooldown(retry_after)  # the next acquire() waits it out
+                continue
+
+            update_response.raise_for_status()
+            if app.debug:  # one line per product is too chatty for production logs
+                logger.info(f"✓ '{product_title[:50]}...' → tag = '{collection_name}' | product_type = '{product_type_value}'")
+
+            return True
+
+        except requests.exceptions.Timeout:
+            logger.warning(f"Timeout updating product {product_id}, attempt {attempt + 1}/{max_retries}")
+            if attempt < max_retries - 1:
+                time.sleep(retry_delay * (attempt + 1))
+                continue
+            return False
+
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Error updating product {product_id}: {str(e)}")
+            if attempt < max_retries - 1:
+                time.sleep(retry_delay * (attempt + 1))
+                continue
+            return False
+
+        except Exception as e:
+            logger.warning(f"Unexpected error updating product {product_id}: {str(e)}")
+            return False
+
+    return False
+
+# Bulk operation that applies one productUpdate per line of the uploaded JSONL file
+BULK_PRODUCT_UPDATE_MUTATION = (
+    "mutation call($input: ProductInput!) { "
+    "productUpdate(input: $input) { product { id } userErrors { field message } } }"
+)
+
+STAGED_UPLOAD_MUTATION = """mutation {
+  stagedUploadsCreate(input: [{resource: BULK_MUTATION_VARIABLES, filename: "product_updates.jsonl", mimeType: "text/jsonl", httpMethod: POST}]) {
+    stagedTargets { url parameters { name value } }
+    userErrors { field message }
+  }
+}"""
+
+RUN_BULK_MUTATION = """mutation($mutation: String!, $path: String!) {
+  bulkOperationRunMutation(mutation: $mutation, stagedUploadPath: $path) {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
+}"""
+
+RUN_BULK_QUERY = """mutation($query: String!) {
+  bulkOperationRunQuery(query: $query) {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
+}"""
+
+CURRENT_BULK_OPERATION_QUERY = """query($type: BulkOperationType!) {
+  currentBulkOperation(type: $type) { id status errorCode objectCount url }
+}"""
+
+CANCEL_BULK_OPERATION = """mutation($id: ID!) {
+  bulkOperationCancel(id: $id) { userErrors { field message } }
+}"""
+
+def shopify_graphql(shop_url, headers, query, variables=None, cost=None, allow_partial=False, max_retries=5):
+    """Run a GraphQL Admin API request and return its data (raises on errors).
+
+    With a cost, first waits until the shop's cost bucket has that many points;
+    every response's throttleStatus keeps the bucket in step with Shopify's. A
+    THROTTLED request ran nothing, so it waits for its cost to refill and is sent
+    again. With allow_partial, errors alongside data are logged and the data returned."""
+    url = f"{shopify_admin_url(shop_url)}/graphql.json"
+    limiter = get_graphql_limiter(shop_url)
+    payload = {"query": query, "variables": variables or {}}
+
+    for attempt in range(max_retries):
+        if cost:
+            limiter.acquire(min(cost, SHOPIFY_GRAPHQL_BUCKET_SIZE))
+
+        response = SHOPIFY_SESSION.post(url, headers=headers, json=payload, timeout=60)
+        response.raise_for_status()
+
+        result = orjson.loads(response.content)
+        query_cost = (result.get("extensions") or {}).get("cost") or {}
+        throttle_status = query_cost.get("throttleStatus")
+        if throttle_status:
+            limiter.observe(throttle_status["currentlyAvailable"])
+
+        errors = result.get("errors")
+        if errors and all((error.get("extensions") or {}).get("code") == "THROTTLED" for error in errors):
+            cost = cost or query_cost.get("requestedQueryCost") or 1
+            logger.warning(f"GraphQL request throttled, retrying ({attempt + 1}/{max_retries})...")
+            continue
+        if errors and not (allow_partial and result.get("data")):
+            raise Exception(f"GraphQL errors: {errors}")
+        if errors:
+            logger.warning(f"GraphQL errors: {errors}")
+        return result["data"]
+
+    raise Exception(f"GraphQL request still throttled after {max_retries} attempts")
+
+def update_products_batch(updates, shop_url, headers):
+    """Set tags and product_type on up to SHOPIFY_GRAPHQL_BATCH_SIZE products in ONE request.
+
+    updates is a list of (product_id, collection_name, product_title); each becomes an
+    aliased productUpdate mutation. Returns {product_id: success}. Products whose mutation
+    failed fall back to per-product REST updates - the whole batch does if the request fails."""
+    params = ", ".join(f"$p{i}: ProductInput!" for i in range(len(updates)))
+    fields = " ".join(f"p{i}: productUpdate(input: $p{i}) {{ userErrors {{ field message }} }}" for i in range(len(updates)))
+    variables = {f"p{i}": {"id": f"gid://shopify/Product/{product_id}", "tags": [name], "productType": name}
+                 for i, (product_id, name, _) in enumerate(updates)}
+
+    try:
+        data = shopify_graphql(shop_url, headers, f"mutation({params}) {{ {fields} }}", variables,
+                               cost=10 * len(updates), allow_partial=True)
+    except Exception as e:
+        logger.warning(f"Batch update failed, updating {len(updates)} products one by one: {str(e)[:100]}")
+        return {product_id: update_product_metadata(product_id, name, title, shop_url, headers)
+                for product_id, name, title in updates}
+
+    results = {}
+    failed = []
+    for i, (product_id, name, title) in enumerate(updates):
+        user_errors = (data.get(f"p{i}") or {}).get("userErrors")
+        if user_errors == []:
+            results[product_id] = True
+            if app.debug:  # one line per product is too chatty for production logs
+                logger.info(f"✓ '{title[:50]}...' → tag = '{name}' | product_type = '{name}'")
+        else:
+            logger.warning(f"Error updating product {product_id}: {user_errors}")
+            failed.append((product_id, name, title))
+
+    # Only the failed aliases are retried - the others are written already
+    for product_id, name, title in failed:
+        results[product_id] = update_product_metadata(product_id, name, title, shop_url, headers)
+    return results
+
+# Current product_type and tags of each product - a product already typed and tagged
+# as the collection name needs no update
+PRODUCT_METADATA_QUERY = """query($ids: [ID!]!) {
+  nodes(ids: $ids) { ... on Product { id productType tags } }
+}"""
+
+def normalize_tags(tags):
+    """Tags as Shopify stores them - split on commas, trimmed, compared case-insensitively"""
+    return frozenset(tag.strip().lower() for value in tags for tag in value.split(",") if tag.strip())
+
+def get_product_metadata(product_ids, shop_url, headers, chunk_size=250):
+    """Look up (product_type, normalized tag set) of many products, 250 ids per GraphQL request"""
+    metadata = {}
+    for start in range(0, len(product_ids), chunk_size):
+        ids = [f"gid://shopify/Product/{product_id}" for product_id in product_ids[start:start + chunk_size]]
+        # nodes costs about one point per product, so it waits its turn in the cost bucket too
+        data = shopify_graphql(shop_url, headers, PRODUCT_METADATA_QUERY, {"ids": ids}, cost=len(ids) + 1)
+        for node in data["nodes"]:
+            if node:
+                metadata[int(node["id"].rsplit("/", 1)[1])] = (node["productType"], normalize_tags(node["tags"]))
+    return metadata
+
+def prefetch_up_to_date_check(product_ids, shop_url, headers):
+    """Start looking up the products' current type and tags on a background thread, so the
+    lookup overlaps collection creation. Returns is_up_to_date(product_id, collection_name),
+    which waits for the lookup on first use; if it failed, every product gets its update.
+
+    Products already typed and tagged as their collection (e.g. on a re-run) are in the
+    smart collection already and need no update."""
+    lookup = ThreadPoolExecutor(max_workers=1)
+    future = lookup.submit(get_product_metadata, product_ids, shop_url, headers)
+    lookup.shutdown(wait=False)
+    metadata = None
+
+    def is_up_to_date(product_id, collection_name):
+        nonlocal metadata
+        if metadata is None:
+            try:
+                metadata = future.result()
+            except Exception as e:
+                logger.warning(f"Could not look up current product types: {str(e)}")
+                metadata = {}
+        # Shopify splits the collection-name tag on commas, so compare the tag sets it stores
+        return metadata.get(product_id) == (collection_name, normalize_tags([collection_name]))
+
+    return is_up_to_date
+
+def poll_bulk_operation(shop_url, headers, operation_type, poll_interval=3, timeout=None):
+    """Poll the shop's current QUERY/MUTATION bulk operation, yielding its state until it finishes.
+
+    Past `timeout` seconds the operation is cancelled (Shopify runs one of each type per shop
+    at a time, so a stuck one would block the next job) and an exception is raised."""
+    deadline = time.monotonic() + timeout if timeout else None
+    while True:
+        time.sleep(poll_interval)
+        operation = shopify_graphql(shop_url, headers, CURRENT_BULK_OPERATION_QUERY,
+                                    {"type": operation_type})["currentBulkOperation"]
+        yield operation
+        if operation["status"] not in ("CREATED", "RUNNING"):
+            return
+        if deadline and time.monotonic() > deadline:
+            try:
+                shopify_graphql(shop_url, headers, CANCEL_BULK_OPERATION, {"id": operation["id"]})
+            except Exception as e:
+                logger.warning(f"Could not cancel bulk operation {operation['id']}: {str(e)}")
+            raise Exception(f"Bulk {operation_type.lower()} still {operation['status']} after {timeout:.0f}s - cancelled")
+
+def fetch_tagged_products_bulk(tag, shop_url, headers):
+    """Export every product with the tag via ONE bulk query, filtered server-side"""
+    search = f"tag:{json.dumps(tag)}"
+    query = "{ products(query: %s) { edges { node { id title } } } }" % json.dumps(search)
+
+    run = shopify_graphql(shop_url, headers, RUN_BULK_QUERY, {"query": query})["bulkOperationRunQuery"]
+    if run["userErrors"]:
+        raise Exception(f"Bulk query rejected: {run['userErrors']}")
+
+    print(f"[BULK EXPORT] Started {run['bulkOperation']['id']} for tag '{tag}'")
+
+    for operation in poll_bulk_operation(shop_url, headers, "QUERY", poll_interval=2,
+                                         timeout=SHOPIFY_BULK_FETCH_TIMEOUT):
+        print(f"  Bulk export {operation['status'].lower()}: {operation.get('objectCount') or 0} products")
+
+    if operation["status"] != "COMPLETED":
+        raise Exception(f"Bulk query {operation['status']} (error: {operation.get('errorCode')})")
+
+    # No url means nothing matched
+    if not operation.get("url"):
+        return []
+
+    output = SHOPIFY_SESSION.get(operation["url"], timeout=120)
+    output.raise_for_status()
+
+    products = []
+    for line in output.content.splitlines():
+        node = orjson.loads(line)
+        # gid://shopify/Product/123 -> 123 (the REST id used everywhere else)
+        products.append({"id": int(node["id"].rsplit("/", 1)[1]), "title": node["title"]})
+    return products
+
+def close_prefetched_page(future):
+    """Done-callback closing a prefetched page nobody will read"""
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+def fetch_tagged_products_rest(tag, shop_url, headers):
+    """Page through products.json and keep products carrying the tag (client-side filter)"""
+    url = f"{shopify_admin_url(shop_url)}/products.json"
+    all_products = []
+    # Only the fields the tag filter and the result need - skips variants, images and
+    # body HTML, which make up most of a full product payload
+    params = {"limit": 250, "fields": "id,title,tags"}
+    page_count = 0
+    max_pages = 100  # Support up to 25,000 products (way more than Shopify's limit)
+
+    # Whole-tag match anywhere in the comma-separated tags string, case-insensitive
+    tag_pattern = re.compile(rf'(?:^|,)\s*{re.escape(tag)}\s*(?:,|$)', re.IGNORECASE)
+
+    # Pages are fetched one ahead on a background thread, so the next download
+    # overlaps with parsing + filtering the current page
+    prefetcher = ThreadPoolExecutor(max_workers=1)
+    stream = ijson is not None
+    print(f"Fetching page 1...")
+    next_page = prefetcher.submit(shopify_get, shop_url, url, headers=headers, params=params, timeout=60, stream=stream)  # Increased timeout
+
+    response = None
+    try:
+        while page_count < max_pages:
+            response = next_page.result()
+            next_page = None
+
+            if response.status_code != 200:
+                raise Exception(f"Shopify API error: {response.status_code} - {response.text}")
+
+            # Start downloading the next page before processing this one
+            next_url = get_next_page_url(response)
+            if next_url and page_count + 1 < max_pages:
+                print(f"Fetching page {page_count + 2}...")
+                next_page = prefetcher.submit(shopify_get, shop_url, next_url, headers=headers, timeout=60, stream=stream)
+
+            # Stream-parse the page one product at a time so the full payload (variants,
+            # images, options) is never materialized - only matches are kept
+            if ijson:
+                response.raw.decode_content = True
+                products = ijson.items(response.raw, 'products.item')
+            else:
+                products = orjson.loads(response.content).get("products", [])
+
+            # Filter by tag
+            page_size = 0
+            matched_on_page = 0
+            for p in products:
+                page_size += 1
+                if tag_pattern.search(p.get("tags") or ""):
+                    all_products.append({"id": p["id"], "title": p["title"]})
+                    matched_on_page += 1
+            response.close()
+
+            print(f"  Retrieved {page_size} products from page {page_count + 1}")
+
+            if not page_size:
+                print("  No more products, stopping pagination")
+                break
+
+            print(f"  Matched {matched_on_page} products with tag '{tag}' on this page")
+            print(f"  Total matched so far: {len(all_products)}")
+
+            # Check pagination
+            if not next_url:
+                print("  No next page link, stopping pagination")
+                break
+
+            page_count += 1
+    finally:
+        # An error or early stop mid-page must not leak the streamed response or the
+        # page still downloading - both hold pooled connections
+        if response is not None:
+            response.close()
+        if next_page is not None and not next_page.cancel():
+            next_page.add_done_callback(close_prefetched_page)
+        prefetcher.shutdown(wait=False)
+
+    print(f"Pagination complete: {page_count + 1} pages fetched, {len(all_products)} products matched")
+
+    return all_products
+
+def bulk_update_product_metadata(updates, shop_url, headers, poll_interval=3):
+    """Set tags + product_type for many products with ONE Shopify bulk operation.
+
+    updates is a list of (product_id, collection_name). Yields the operation
+    status while Shopify processes it, then a final state with a
+    {product_id: success} 'results' dict. Raises if the operation can't run."""
+    # Upload one productUpdate input per line
+    jsonl = b"\n".join(
+        orjson.dumps({"input": {"id": f"gid://shopify/Product/{product_id}", "tags": [name], "productType": name}})
+        for product_id, name in updates
+    )
+
+    staged = shopify_graphql(shop_url, headers, STAGED_UPLOAD_MUTATION)["stagedUploadsCreate"]
+    if staged["userErrors"]:
+        raise Exception(f"Staged upload failed: {staged['userErrors']}")
+
+    target = staged["stagedTargets"][0]
+    params = {p["name"]: p["value"] for p in target["parameters"]}
+    upload_response = SHOPIFY_SESSION.post(target["url"], data=params,
+                                    files={"file": ("product_updates.jsonl", jsonl, "text/jsonl")}, timeout=120)
+    upload_response.raise_for_status()
+
+    run = shopify_graphql(shop_url, headers, RUN_BULK_MUTATION,
+                          {"mutation": BULK_PRODUCT_UPDATE_MUTATION, "path": params["key"]})["bulkOperationRunMutation"]
+    if run["userErrors"]:
+        raise Exception(f"Bulk operation rejected: {run['userErrors']}")
+
+    logger.info(f"[BULK UPDATE] Started {run['bulkOperation']['id']} for {len(updates)} products")
+
+    # Poll until Shopify finishes
+    for operation in poll_bulk_operation(shop_url, headers, "MUTATION", poll_interval,
+                                         timeout=SHOPIFY_BULK_UPDATE_TIMEOUT):
+        if operation["status"] in ("CREATED", "RUNNING"):
+            yield {'status': operation["status"], 'object_count': int(operation.get("objectCount") or 0)}
+
+    if operation["status"] != "COMPLETED":
+        raise Exception(f"Bulk operation {operation['status']} (error: {operation.get('errorCode')})")
+
+    # Each result line carries the __lineNumber of the input it belongs to
+    results = {product_id: True for product_id, _ in updates}
+    if operation.get("url"):
+        output = SHOPIFY_SESSION.get(operation["url"], timeout=120)
+        output.raise_for_status()
+        for line in output.text.splitlines():
+            row = orjson.loads(line)
+            line_number = row.get("__lineNumber")
+            if line_number is None or line_number >= len(updates):
+                continue
+            product_update = (row.get("data") or {}).get("productUpdate") or {}
+            if row.get("errors") or product_update.get("userErrors"):
+                results[updates[line_number][0]] = False
+
+    logger.info(f"[BULK UPDATE] Completed: {sum(results.values())}/{len(updates)} products updated")
+    yield {'status': operation["status"], 'object_count': len(updates), 'results': results}
+
+if __name__ == '__main__':
+    app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
@@ -0,0 +1,18 @@
+import os
+
+# gevent workers serve each request on a greenlet, so long-lived SSE streams
+# (classification / Shopify update progress) don't tie up a whole worker.
+# The gevent worker monkey-patches sockets itself, so requests calls yield
+# while waiting on Shopify/OpenAI.
+worker_class = "gevent"
+worker_connections = 1000
+
+# Without Redis, sessions, background task status and the OpenAI/Shopify rate
+# limits live in process memory, so one worker by default - a single gevent worker
+# already handles many concurrent streams. With REDIS_URL set every worker sees the
+# same sessions, task progress and rate-limit buckets, so spread the streams over
+# several worker processes
+workers = int(os.environ.get("WEB_CONCURRENCY", 4 if os.environ.get("REDIS_URL") else 1))
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+timeout = 120
@@ -6,7 +6,14 @@ from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import openai
 import json
+import re
+import time
 from threading import Thread
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Shopify returns the new resource URL in the Location header on create,
+# e.g. /admin/api/2024-01/custom_collections/12345.json
+LOCATION_ID_RE = re.compile(r'/(\d+)\.json')
 
 class ShopifyProductClassifier:
     def __init__(self, root):
@@ -85,6 +92,10 @@ class ShopifyProductClassifier:
         
         self.products = []
         self.classified_collections = {}
+        # Lowercased title -> ID of the shop's custom collections, loaded once per update run
+        self.collection_ids = None
+        # One keep-alive connection pool for every Shopify call instead of a new TLS handshake each time
+        self.http = requests.Session()
         
     def log(self, message):
         self.log_area.insert(tk.END, message + "\n")
@@ -103,48 +114,41 @@ class ShopifyProductClassifier:
             
             self.log(f"Fetching products with tag: {tag}")
             
-            # Shopify Admin API endpoint
-            url = f"https://{shop_url}/admin/api/2024-01/products.json"
+            # Shopify Admin GraphQL endpoint - filters by tag server-side, so only
+            # matching products are downloaded
+            url = f"https://{shop_url}/admin/api/2024-01/graphql.json"
             headers = {
                 "X-Shopify-Access-Token": access_token,
                 "Content-Type": "application/json"
             }
+            query = """
+            query($search: String!, $after: String) {
+              products(first: 250, query: $search, after: $after) {
+                edges { node { id title } }
+                pageInfo { hasNextPage endCursor }
+              }
+            }"""
+            variables = {"search": f"tag:{json.dumps(tag)}", "after": None}
             
             all_products = []
-            params = {"limit": 250}
             
             while True:
-                response = requests.get(url, headers=headers, params=params)
+                response = self.http.post(url, headers=headers, json={"query": query, "variables": variables})
                 response.raise_for_status()
                 data = response.json()
+                if data.get("errors"):
+                    raise Exception(f"Shopify GraphQL error: {data['errors']}")
                 
-                products = data.get("products", [])
-                if not products:
-                    break
-                
-                # Filter by tag
-                for p in products:
-                    product_tags = [t.strip().lower() for t in p.get("tags", "").split(",")]
-                    if tag.lower() in product_tags:
-                        all_products.append((p["id"], p["title"]))
+                products = data["data"]["products"]
+                for edge in products["edges"]:
+                    node = edge["node"]
+                    # gid://shopify/Product/123 -> 123, the id the REST calls below use
+                    all_products.append((int(node["id"].rsplit("/", 1)[1]), node["title"]))
                 
                 # Check for pagination
-                link_header = response.headers.get("Link", "")
-                if "rel=\"next\"" not in link_header:
-                    break
-                
-                # Extract next page URL
-                next_url = None
-                for link in link_header.split(","):
-                    if "rel=\"next\"" in link:
-                        next_url = link.split(";")[0].strip("<> ")
-                        break
-                
-                if not next_url:
+                if not products["pageInfo"]["hasNextPage"]:
                     break
-                    
-                url = next_url
-                params = {}
+                variables["after"] = products["pageInfo"]["endCursor"]
             
             self.products = all_products
             
@@ -229,16 +233,19 @@ Example format:
     def create_or_get_collection(self, collection_name, shop_url, access_token, headers):
         """Create a new collection or get existing one by title"""
         try:
-            # Search for existing collection
-            search_url = f"https://{shop_url}/admin/api/2024-01/custom_collections.json"
-            response = requests.get(search_url, headers=headers)
-            response.raise_for_status()
+            # Search for existing collection - the list is fetched on the first lookup only
+            if self.collection_ids is None:
+                search_url = f"https://{shop_url}/admin/api/2024-01/custom_collections.json"
+                response = self.http.get(search_url, headers=headers, params={"limit": 250, "fields": "id,title"})
+                response.raise_for_status()
+                
+                self.collection_ids = {col["title"].lower(): col["id"]
+                                       for col in response.json().get("custom_collections", [])}
             
-            collections = response.json().get("custom_collections", [])
-            for col in collections:
-                if col["title"].lower() == collection_name.lower():
-                    self.log(f"  ℹ Collection '{collection_name}' already exists (ID: {col['id']})")
-                    return col["id"]
+            existing_id = self.collection_ids.get(collection_name.lower())
+            if existing_id:
+                self.log(f"  ℹ Collection '{collection_name}' already exists (ID: {existing_id})")
+                return existing_id
             
             # Create new collection
             create_url = f"https://{shop_url}/admin/api/2024-01/custom_collections.json"
@@ -248,10 +255,13 @@ Example format:
                     "published": True
                 }
             }
-            response = requests.post(create_url, headers=headers, json=payload)
+            response = self.http.post(create_url, headers=headers, json=payload)
             response.raise_for_status()
             
-            collection_id = response.json()["custom_collection"]["id"]
+            # Prefer the Location header - only parse the full body if it's missing
+            match = LOCATION_ID_RE.search(response.headers.get("Location", ""))
+            collection_id = int(match.group(1)) if match else response.json()["custom_collection"]["id"]
+            self.collection_ids[collection_name.lower()] = collection_id
             self.log(f"  ✓ Created collection '{collection_name}' (ID: {collection_id})")
             return collection_id
             
@@ -260,16 +270,21 @@ Example format:
             return None
     
     def add_product_to_collection(self, product_id, collection_id, shop_url, access_token, headers):
-        """Add a product to a collection"""
-        try:
-            url = f"https://{shop_url}/admin/api/2024-01/collects.json"
-            payload = {
-                "collect": {
-                    "product_id": product_id,
-                    "collection_id": collection_id
-                }
+        """Add a product to a collection (runs on a worker thread, so it raises instead of logging)"""
+        url = f"https://{shop_url}/admin/api/2024-01/collects.json"
+        payload = {
+            "collect": {
+                "product_id": product_id,
+                "collection_id": collection_id
             }
-            response = requests.post(url, headers=headers, json=payload)
+        }
+        for attempt in range(3):
+            response = self.http.post(url, headers=headers, json=payload)
+            
+            # Shopify's rate limit - wait as long as it asks, then retry
+            if response.status_code == 429 and attempt < 2:
+                time.sleep(float(response.headers.get('Retry-After', 2)))
+                continue
             
             # 422 means product is already in collection, which is fine
             if response.status_code == 422:
@@ -277,10 +292,6 @@ Example format:
             
             response.raise_for_status()
             return True
-            
-        except Exception as e:
-            self.log(f"    ✗ Failed to add product to collection: {str(e)}")
-            return False
     
     def update_shopify(self):
         try:
@@ -290,6 +301,7 @@ Example format:
             
             self.log("\n--- Creating Collections & Adding Products ---")
             success_count = 0
+            self.collection_ids = None  # re-read the shop's collections on each run
             
             shop_url = self.shop_url.get().strip()
             access_token = self.access_token.get().strip()
@@ -309,17 +321,21 @@ Example format:
                     self.log(f"  ⚠ Skipping products for '{collection_name}' due to collection error")
                     continue
                 
-                # Add products to collection
-                for idx in indices:
-                    if 1 <= idx <= len(self.products):
-                        product_id, title = self.products[idx - 1]
-                        
-                        # Add to collection
-                        if self.add_product_to_collection(product_id, collection_id, shop_url, access_token, headers):
+                # Add products to collection, a few requests in flight at once -
+                # results are logged here, on this thread, as each one finishes
+                with ThreadPoolExecutor(max_workers=4) as executor:
+                    futures = {executor.submit(self.add_product_to_collection, self.products[idx - 1][0],
+                                               collection_id, shop_url, access_token, headers): self.products[idx - 1][1]
+                               for idx in indices if 1 <= idx <= len(self.products)}
+                    
+                    for future in as_completed(futures):
+                        title = futures[future]
+                        try:
+                            future.result()
                             self.log(f"    ✓ Added: {title[:60]}...")
                             success_count += 1
-                        else:
-                            self.log(f"    ✗ Failed: {title[:60]}...")
+                        except Exception as e:
+                            self.log(f"    ✗ Failed: {title[:60]}... ({str(e)})")
             
             status = "SUCCESS" if success_count == len(self.products) else "PARTIAL SUCCESS"
             self.log(f"\n{status}: Added {success_count}/{len(self.products)} products to collections")